@@ -1,509 +1,2542 @@
-import os
-import re
-import json
-import sqlite3
-from datetime import datetime, timedelta
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from pydantic import BaseModel
-from jose import JWTError, jwt
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base, Session
-import PyPDF2
-import docx
-from dotenv import load_dotenv
-import google.generativeai as genai
-from pinecone import Pinecone, ServerlessSpec
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-from phi.agent import Agent
-from phi.tools.duckduckgo import DuckDuckGo
-from phi.tools.serpapi_tools import SerpApiTools
-from phi.tools.website import WebsiteTools
-from phi.model.google import Gemini
-
-
-load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
-SECRET_KEY = os.getenv("SECRET_KEY") 
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-genai.configure(api_key=GOOGLE_API_KEY)
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-
-DATABASE_URL = "sqlite:///./app.db"
-
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
-Base = declarative_base()
-
-class User(Base):
-    __tablename__ = "users"
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, unique=True, index=True)
-    password = Column(String)
-
-
-class FileRecord(Base):
-    __tablename__ = "files"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    file_name = Column(String)
-    pinecone_index = Column(String)
-    file_content = Column(Text)
-
-
-class Conversation(Base):
-    __tablename__ = "conversations"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    file_id = Column(Integer, ForeignKey("files.id"))
-    role = Column(String)
-    content = Column(Text)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-
-
-Base.metadata.create_all(bind=engine)
-
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def create_access_token(data: dict, expires_delta: timedelta | None = None):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
-
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials"
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        raise credentials_exception
-    return user
-
-class UserCreate(BaseModel):
-    username: str
-    password: str
-
-
-class TokenData(BaseModel):
-    access_token: str
-    token_type: str
-
-
-class FileUploadResponse(BaseModel):
-    message: str
-
-
-class FileInfo(BaseModel):
-    id: int
-    file_name: str
-    file_content: str | None = None
-
-class ChatQuery(BaseModel):
-    file_id: int
-    query: str
-    history: str = ""  
-
-
-class ChatResponse(BaseModel):
-    response: str
-
-
-class ConversationRecord(BaseModel):
-    id: int
-    role: str
-    content: str
-    timestamp: datetime
-
-
-def create_pc(api_key: str):
-    return Pinecone(api_key=api_key)
-
-
-def sanitize_file_name(file_name: str) -> str:
-    sanitized_name = re.sub('[^a-z0-9-]', '', file_name.strip().lower().replace(" ", "-"))
-    return f"faq-{sanitized_name}"
-
-
-async def parse_file_content(uploaded_file: UploadFile, file_ext: str) -> tuple[str, list[str]]:
-    faq_texts = []
-    file_content = ""
-    if file_ext == ".json":
-        file_content = await uploaded_file.file.read().decode("utf-8")
-        faq_data = json.loads(file_content)
-        faq_texts = [f"Q: {item['question']}\nA: {item['answer']}" for item in faq_data]
-    elif file_ext == ".txt":
-        file_content = await uploaded_file.file.read().decode("utf-8")
-        faq_texts = [chunk.strip() for chunk in file_content.split("\n\n") if chunk.strip()]
-    elif file_ext == ".pdf":
-        pdf_reader = PyPDF2.PdfReader(uploaded_file.file)
-        file_content = ""
-        for page in pdf_reader.pages:
-            file_content += page.extract_text() + "\n"
-        faq_texts = [chunk.strip() for chunk in file_content.split("\n\n") if chunk.strip()]
-    elif file_ext == ".docx":
-        doc = docx.Document(uploaded_file.file)
-        file_content = "\n".join([para.text for para in doc.paragraphs])
-        faq_texts = [chunk.strip() for chunk in file_content.split("\n\n") if chunk.strip()]
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported file type.")
-    return file_content, faq_texts
-
-
-def get_full_faq_text(file_index: str, pc: Pinecone) -> str:
-    file_index_instance = pc.Index(file_index)
-    res = file_index_instance.query(vector=[0.0] * 768, top_k=1000, include_metadata=True)
-    return "\n".join([match["metadata"].get("text", "") for match in res.get("matches", [])])
-
-
-def modify_query_for_web(query: str, context: str) -> str:
-    mod_model = genai.GenerativeModel(model_name="gemini-2.0-flash")
-    mod_prompt = f"""
-    Given the FAQ Context: {context}
-    And the user query: {query}
-    Extract only the essential part of the query necessary for a web search.
-    Provide a concise modified query focusing on key terms.
-    """
-    mod_response = mod_model.generate_content(mod_prompt).text
-    return mod_response.strip()
-
-
-def get_web_answer(query: str) -> str:
-    prompt = f"Search the web and answer the following question: {query}"
-    serp_agent = Agent(
-        model=Gemini(model="gemini-2.0-flash", api_key=GOOGLE_API_KEY),
-        tools=[DuckDuckGo(), SerpApiTools(api_key=SERPAPI_API_KEY), WebsiteTools()],
-        instructions=["Search the web for the most relevant and accurate information to answer the question briefly. Do not ask follow-up questions."]
-    )
-    try:
-        response = serp_agent.run(prompt)
-        return response.get_content_as_string()
-    except Exception:
-        return ""
-
-
-def gen_summary(text: str) -> str:
-    mo = genai.GenerativeModel(model_name="gemini-2.0-flash", 
-                                 system_instruction="You are a detailed report generator from the FAQ context. Generate a very detailed analysis report on every detail of the given FAQ context.")
-    resp = mo.generate_content(f"Provide a very detailed analysis report regarding everything about the details and information covered based on the given FAQ document context\nFAQ Context: {text}").text
-    return resp
-
-
-def is_unsatisfactory(web_answer: str) -> bool:
-    check_model = genai.GenerativeModel(model_name="gemini-2.0-flash", 
-        system_instruction="""You are a sentence classifier. Your task is to analyze each provided sentence and determine whether it is "satisfactory" or "not satisfactory" based on the following criteria:
-Satisfactory: The sentence conveys a positive meaning, includes clear and sufficient information, and directly provides the answer or solution.
-Not Satisfactory: The sentence either lacks enough information, explicitly states that it does not have the answer (e.g., "I don't have the answer"), or fails to address the query effectively."""
-    )
-    few_shot_prompt = f"""
-For each sentence, provide your classification along with a brief explanation of your reasoning.
-
-Example 1:
-Input Sentence: "The capital of France is Paris."
-Output: Satisfactory – because the sentence gives a clear and correct answer along with necessary information.
-
-Example 2:
-Input Sentence: "I don't have the answer."
-Output: Not Satisfactory – because it explicitly states a lack of an answer and provides no additional information.
-
-Example 3:
-Input Sentence: "I was unable to find the information regarding the data you requested."
-Output: Not Satisfactory – because it explicitly states a lack of an answer and provides no additional information.
-
-Example 4:
-Input Sentence: "The provided FAQ document does not contain information about who founded ShopTalk. Since I was unable to find the answer using web search, I cannot answer who is the founder of shoptalk."
-Output: Not Satisfactory – because it explicitly states a lack of an answer and provides no additional information.
-
-Now, please classify the following sentences:
-Sentences: "{web_answer}"
-"""
-    result = check_model.generate_content(few_shot_prompt).text.lower().strip()
-    return "unsatisfactory" in result
-
-
-def handle_query(query, history, faq_context, vector_store):
-    summary = gen_summary(faq_context)  
-
-    classification_prompt = f"""
-    You are an FAQ chatbot. Analyze the provided FAQ context and the user query.
-- If the query is more like the greeting, closing, or any other general conversation like 'Hello..', 'Greetings..', etc.., respond with "Greeting".
-- If the query is not related to the topic of the FAQ context and also the history of the conversation, at all (i.e., less than 10% related), respond with "unrelated".
-- If the query is related to the FAQ context and also the history of the conversation, but the answer is not available in the FAQ context, then label it as "needs web search". If after attempting web search the answer is still not found, label it as "keep in db".        
-- If the query is answerable directly from the FAQ context, provide the answer using the context.
-- If it's a follow-up question (e.g., "Tell me more", "Can you explain further", etc.), label it as "follow up".
-    FAQ Context: {faq_context}
-    User Query: {query}
-    History : {history}
-    """
-    model = genai.GenerativeModel(model_name='gemini-2.0-flash')
-    classification_response = model.generate_content(classification_prompt).text.lower()
-    
-    if "unrelated" in classification_response:
-        alt_response = model.generate_content(f"""
-Prompt:
-You are a query classifier. Your task is to determine whether a given query is related to the provided reference content. The reference content can be any document—this may include FAQs, articles, bullet points, or any other format—and it can cover any topic.
-
-Instructions:
-
-Reference Content:
-You will receive a piece of content. It could be in any format (plain text, JSON, bullet points, etc.) and about any topic or information.
-
-Classification Task:
-When you receive a query, use the following rules to classify it:
-
-YES: If the query is related to the content provided.
-Example: If the reference is about a workplace collaboration tool and the query asks, "Who is the founder of [tool]?" or "What is meant by the [particular feature] of the [tool] ?" it should be classified as YES, even if the founder's name isn’t mentioned.
-NO: If the query is unrelated to the provided content.
-Example: If the reference is about a workplace tool and the query asks, "What are Elon Musk's latest projects?" it should be classified as NO.
-Output Format:
-For each query, respond with either YES or NO (without any additional commentary).
-
-Example Scenario:
-
-Reference Content (any format):
-"This document describes a new collaboration tool that helps teams manage projects, share files, and communicate effectively."
-
-Query: "How can teams share files using this tool?"
-Output: YES
-
-Query : "What are similar products available in the market?"
-Output: YES
-                                              
-Query: "What is the history of space exploration?"
-Output: NO
-
-Now, using these guidelines, classify the following query:
-                                                       
-{faq_context}
-Query: {query}
-Output (YES or NO):
-""").text
-        if "yes" in alt_response.lower():
-            vector_store.add_texts([query], namespace="New Queries")
-            return "This answer will be provided in the future."
-        else:
-            return "It is not related to the document."
-
-    elif "greeting" in classification_response:
-        greeting_prompt = f"""
-        Answer the general user query based on the conversation history, provided
-        If the conversation history is empty, provide a general response.
-        User Query: {query}
-        Chat History: {history}
-        """
-        return model.generate_content(greeting_prompt).text
-        
-    elif "needs web search" in classification_response:
-        modified_query = modify_query_for_web(query, summary)
-        web_answer = get_web_answer(modified_query)
-        combined_prompt = f"""
-        Answer the following user query using both the FAQ context and the web information.
-        If the web information is not relevant or is unable to provide an answer, then perform your own web search and use your own knowledge to answer the User Query based on the provided FAQ Context.
-        Consider the Chat history for conversation context.
-        User Query: {query}
-        FAQ Context: {summary}
-        Web Information: {web_answer}
-        Chat History: {history}
-
-        Note : In the response, do not provide like, "As per the FAQ context, the answer is" or "Based on the provided FAQ Context". Instead, provide the answer directly.
-        Note: In the response, do not provide anything like 'I found this information on the web' or 'I searched the web for you' or 'Based on the provided FAQ Context'. Instead, provide the answer directly.
-        Note : The answer should always be on support of the FAQ context.
-        """
-        final_response = model.generate_content(combined_prompt).text
-        if not final_response.strip() or is_unsatisfactory(final_response):
-            vector_store.add_texts([query], namespace="New Queries")
-            return "This answer will be provided in the future."
-        else:
-            vector_store.add_texts([f"Query: {query}\nResponse: {final_response}"], namespace="Web Queries")
-            return final_response
-    elif "follow up" in classification_response:
-        follow_up_prompt = f"""
-        Answer the user query based on the provided FAQ context and the chat history.
-        User Query: {query}
-        FAQ Context Summary: {summary}
-        Chat History: {history}
-        """
-        return model.generate_content(follow_up_prompt).text
-    else:
-        prompt = f"User Query: {query}\nFAQ Context Summary: {summary}\nChat History: {history}\nProvide a direct answer."
-        return model.generate_content(prompt).text
-
-
-def store_conversation(db: Session, user_id: int, file_id: int, role: str, content: str):
-    conv = Conversation(user_id=user_id, file_id=file_id, role=role, content=content)
-    db.add(conv)
-    db.commit()
-    db.refresh(conv)
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-@app.post("/signup", status_code=201)
-def signup(user: UserCreate, db: Session = Depends(get_db)):
-    if db.query(User).filter(User.username == user.username).first():
-        raise HTTPException(status_code=400, detail="Username already exists.")
-    new_user = User(username=user.username, password=user.password)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return {"message": "Signup successful. Please log in."}
-
-
-@app.post("/login", response_model=TokenData)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username, User.password == form_data.password).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    access_token = create_access_token(data={"sub": user.username})
-    return {"access_token": access_token, "token_type": "bearer"}
-
-@app.post("/files/upload", response_model=FileUploadResponse)
-async def upload_file(
-    pinecone_api_key: str = Form(...),
-    file_name: str = Form(...),
-    file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    pc = create_pc(pinecone_api_key)
-    file_ext = os.path.splitext(file.filename)[1].lower()
-    try:
-        file_content, faq_texts = await parse_file_content(file, file_ext)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    file_index = sanitize_file_name(file_name)
-    
-    indexes = [i['name'] for i in pc.list_indexes()]
-    if file_index not in indexes:
-        pc.create_index(
-            name=file_index,
-            dimension=768,
-            metric='cosine',
-            spec=ServerlessSpec(cloud='aws', region='us-east-1'),
-        )
-    file_index_instance = pc.Index(file_index)
-    file_vector_store = PineconeVectorStore(index=file_index_instance, embedding=embeddings)
-    file_vector_store.add_texts(faq_texts)
-    
-    new_file = FileRecord(user_id=current_user.id, file_name=file_name, pinecone_index=file_index, file_content=file_content)
-    db.add(new_file)
-    db.commit()
-    db.refresh(new_file)
-    return {"message": "File uploaded and processed successfully!"}
-
-
-@app.get("/files", response_model=list[FileInfo])
-def list_files(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    files = db.query(FileRecord).filter(FileRecord.user_id == current_user.id).all()
-    return [{"id": f.id, "file_name": f.file_name} for f in files]
-
-
-@app.get("/files/{file_id}", response_model=FileInfo)
-def get_file(file_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    file_rec = db.query(FileRecord).filter(FileRecord.id == file_id, FileRecord.user_id == current_user.id).first()
-    if not file_rec:
-        raise HTTPException(status_code=404, detail="File not found")
-    return {"id": file_rec.id, "file_name": file_rec.file_name, "file_content": file_rec.file_content}
-
-@app.post("/chat/query", response_model=ChatResponse)
-def chat_query(
-    pinecone_api_key: str = Form(...),
-    file_id: int = Form(...),
-    query: str = Form(...),
-    history: str = Form(""),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    
-    file_rec = db.query(FileRecord).filter(FileRecord.id == file_id, FileRecord.user_id == current_user.id).first()
-    if not file_rec:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    pc = create_pc(pinecone_api_key)
-    vector_store = PineconeVectorStore(index=pc.Index(file_rec.pinecone_index), embedding=embeddings)
-    faq_context = get_full_faq_text(file_rec.pinecone_index, pc)
-        
-    history_str = history  
-    model = genai.GenerativeModel(model_name="gemini-2.0-flash")
-    user_query = model.generate_content(
-                    f"""
-                    Rewrite the given query to remove pronouns and clarify shortcuts.
-                    Consider the following common shortcuts: "shld = should", "wt = what", "abt = about", "wdym = what do you mean", "exp = explain", "plz = please", "u = you", "r = are", "w = with", "w/o = without", "wrt = with respect to", "wrt = with regard to", "wrt = with reference to".
-                    Example 1:
-                    Input: What is shoptalk
-                    Output: Who are shoptalk competitors?
-                    Example 2:
-                    Input: Explain the features of shoptalk
-                    Output: Explain the features of shoptalk in detail
-                    Example 3:
-                    Input: What is the pricing of shoptalk
-                    Output: Explain about the pricing of shoptalk in detail
-
-                    User Query: {query}
-                    Chat History: {history}
-                    Output: Provide only the modified query as a single sentence."""
-                ).text.strip()   
-    
-    bot_response = handle_query(user_query, history_str, faq_context, vector_store)
-    store_conversation(db, current_user.id, file_rec.id, "user", query)
-    store_conversation(db, current_user.id, file_rec.id, "assistant", bot_response)
-    
-    return {"response": bot_response}
-
-
-
-@app.get("/chat/history/{file_id}", response_model=list[ConversationRecord])
-def chat_history(file_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    convs = db.query(Conversation).filter(Conversation.file_id == file_id, Conversation.user_id == current_user.id).order_by(Conversation.timestamp).all()
-    return [
-        ConversationRecord(
-            id=c.id,
-            role=c.role,
-            content=c.content,
-            timestamp=c.timestamp
-        )
-        for c in convs
-    ]
-
-@app.post("/config/pinecone")
-def config_pinecone(pinecone_api_key: str = Form(...)):
-    try:
-        pc = create_pc(pinecone_api_key)
-        return {"message": "Pinecone API key is valid."}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
-
-
+import io
+import os
+import functools
+import importlib
+import asyncio
+import queue
+import logging
+from itertools import chain, islice
+import re
+import json
+import hashlib
+import hmac
+import base64
+import sqlite3
+import shutil
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from pydantic import BaseModel
+from jose import JWTError, jwt
+from sqlalchemy import create_engine, event, inspect, text, func, or_, Column, Index, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+# The Gemini, Pinecone, phi and document parser SDKs take seconds to import, so they are
+# imported on first use inside the functions below rather than here.
+
+
+load_dotenv()
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+SECRET_KEY = os.getenv("SECRET_KEY") 
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+FAQ_CACHE_MAX_BYTES = int(os.getenv("FAQ_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CONTEXT_MODES = ("full", "retrieval")
+DEFAULT_CONTEXT_MODE = os.getenv("CONTEXT_MODE", "full")
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "./vector_data")
+EMBEDDING_DIM = 768
+ROUTING_MODE = os.getenv("ROUTING_MODE", "single")
+ROUTE_INTENTS = ("greeting", "answer", "follow_up", "needs_web_search", "unrelated")
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "16"))
+VECTOR_CONCURRENCY = int(os.getenv("VECTOR_CONCURRENCY", "8"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "4"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "16"))
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+FUTURE_ANSWER = "This answer will be provided in the future."
+SUPPORTED_EXTENSIONS = (".json", ".txt", ".pdf", ".docx")
+CHUNK_MAX_CHARS = int(os.getenv("CHUNK_MAX_CHARS", "2000"))
+CHUNK_OVERLAP_CHARS = int(os.getenv("CHUNK_OVERLAP_CHARS", "200"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", "60"))
+EMBEDDING_MODEL = "models/embedding-001"
+CHAT_MODEL = "gemini-2.0-flash"
+CLIENT_CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", "32"))
+INDEX_LIST_TTL_SECONDS = int(os.getenv("INDEX_LIST_TTL_SECONDS", "300"))
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "5"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000"))
+MEMORY_SUMMARY_TOKEN_BUDGET = int(os.getenv("MEMORY_SUMMARY_TOKEN_BUDGET", "300"))
+MEMORY_FOLD_BATCH = 20
+WEB_CACHE_TTL_SECONDS = int(os.getenv("WEB_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+WEB_SEARCH_TIMEOUT_SECONDS = float(os.getenv("WEB_SEARCH_TIMEOUT_SECONDS", "20"))
+WEB_MAX_RESULTS = 5
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", "200000"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.db")
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "100"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "10"))
+WARM_UP_CLIENTS = os.getenv("WARM_UP_CLIENTS", "true").lower() == "true"
+
+logger = logging.getLogger("faq_chatbot")
+trace_logger = logging.getLogger("faq_chatbot.trace")
+if TRACING_ENABLED and not trace_logger.handlers:
+    # One JSON object per chat request; route it elsewhere by configuring this logger.
+    _trace_handler = logging.StreamHandler()
+    _trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(_trace_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run alongside the single writer; NORMAL sync is durable enough in WAL mode.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+Base = declarative_base()
+
+class User(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, unique=True, index=True)
+    password = Column(String)
+
+
+class FileRecord(Base):
+    __tablename__ = "files"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    file_name = Column(String)
+    pinecone_index = Column(String)
+    file_content = Column(Text)
+    context_mode = Column(String, default=DEFAULT_CONTEXT_MODE)
+    status = Column(String, default="ready")
+    # Highest chunk id of the last completed ingestion, used to version per-process caches; NULL for older files.
+    live_chunk_id = Column(Integer)
+
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    file_id = Column(Integer, ForeignKey("files.id"))
+    role = Column(String)
+    content = Column(Text)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+    # History is read per user and file in insertion order, which id follows.
+    __table_args__ = (Index("ix_conversations_user_file_id", "user_id", "file_id", "id"),)
+
+
+class ConversationMemory(Base):
+    __tablename__ = "conversation_memories"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    file_id = Column(Integer, ForeignKey("files.id"))
+    summary = Column(Text, default="")
+    summarized_through = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_conversation_memories_user_file", "user_id", "file_id", unique=True),)
+
+
+class FileChunk(Base):
+    __tablename__ = "file_chunks"
+    id = Column(Integer, primary_key=True, index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), index=True)
+    position = Column(Integer)
+    text = Column(Text)
+    vector_id = Column(String)
+
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), index=True)
+    status = Column(String, default="queued")
+    stage = Column(String, default="queued")
+    chunk_count = Column(Integer, default=0)
+    chunks_added = Column(Integer, default=0)
+    chunks_unchanged = Column(Integer, default=0)
+    chunks_removed = Column(Integer, default=0)
+    base_chunk_id = Column(Integer)
+    stage_timings = Column(Text, default="{}")
+    error = Column(Text)
+    upload_path = Column(String)
+    file_ext = Column(String)
+    worker_id = Column(String)
+    heartbeat_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class WebSearchResult(Base):
+    __tablename__ = "web_search_cache"
+    id = Column(Integer, primary_key=True, index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), index=True)
+    query_key = Column(String, unique=True, index=True)
+    query = Column(Text)
+    answer = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class FileSummary(Base):
+    __tablename__ = "file_summaries"
+    id = Column(Integer, primary_key=True, index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), unique=True, index=True)
+    content_hash = Column(String)
+    summary = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+def migrate_schema():
+    # create_all only creates missing tables, so columns and indexes added to existing models are added here.
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def init_db():
+    Base.metadata.create_all(bind=engine)
+    migrate_schema()
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def create_access_token(data: dict, expires_delta: timedelta | None = None):
+    to_encode = data.copy()
+    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"exp": expire})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def hash_password(password: str, iterations: int = PASSWORD_HASH_ITERATIONS) -> str:
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+
+def verify_password(password: str, stored: str) -> tuple[bool, bool]:
+    """Return (matches, needs_rehash); passwords stored before hashing was added are compared as plaintext."""
+    if not stored.startswith("pbkdf2_sha256$"):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8")), True
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), base64.b64decode(salt), int(iterations))
+        return hmac.compare_digest(candidate, base64.b64decode(digest)), int(iterations) != PASSWORD_HASH_ITERATIONS
+    except ValueError:
+        logger.warning("Malformed password hash")
+        return False, False
+
+
+@functools.cache
+def dummy_password_hash() -> str:
+    # Built on first use rather than at import, since hashing takes tens of milliseconds.
+    return hash_password(uuid.uuid4().hex)
+
+
+class CurrentUser(BaseModel):
+    id: int
+    username: str
+
+
+class UserCache:
+    """Short-lived user-id -> username lookups, so authenticated requests skip the users table.
+
+    There is no user delete or disable path, so nothing is invalidated explicitly; a removed user is
+    rejected once their entry expires after ttl_seconds.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # Every entry gets the same TTL, so insertion order is expiry order and expired entries sit at the front.
+        self._entries: OrderedDict[int, tuple[str | None, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> tuple[bool, str | None]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or time.monotonic() > entry[1]:
+            return False, None
+        return True, entry[0]
+
+    def put(self, user_id: int, username: str | None):
+        # A missing user is cached too, so a deleted user is rejected without a query until the entry expires.
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (username, now + self.ttl_seconds)
+            while self._entries and (len(self._entries) > self.max_entries or next(iter(self._entries.values()))[1] < now):
+                self._entries.popitem(last=False)
+
+
+user_cache = UserCache(USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_ENTRIES)
+
+
+def lookup_user(user_id: int | None, username: str) -> CurrentUser | None:
+    if user_id is not None:
+        found, cached_name = user_cache.get(user_id)
+        if found:
+            return CurrentUser(id=user_id, username=cached_name) if cached_name == username else None
+    with SessionLocal() as db:
+        query = db.query(User.id, User.username)
+        row = query.filter(User.id == user_id).first() if user_id is not None else query.filter(User.username == username).first()
+    if user_id is not None or row is not None:
+        user_cache.put(row.id if row else user_id, row.username if row else None)
+    return CurrentUser(id=row.id, username=row.username) if row and row.username == username else None
+
+
+def get_current_user(token: str = Depends(oauth2_scheme)) -> CurrentUser:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials"
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+    # Tokens carry the user id; tokens issued before that are resolved by username.
+    user = lookup_user(payload.get("uid"), username)
+    if user is None:
+        raise credentials_exception
+    return user
+
+class UserCreate(BaseModel):
+    username: str
+    password: str
+
+
+class TokenData(BaseModel):
+    access_token: str
+    token_type: str
+
+
+class FileUploadResponse(BaseModel):
+    message: str
+    job_id: int
+    file_id: int
+
+
+class IngestionJobInfo(BaseModel):
+    id: int
+    file_id: int
+    status: str
+    stage: str
+    chunk_count: int
+    chunks_added: int
+    chunks_unchanged: int
+    chunks_removed: int
+    stage_timings: dict[str, float]
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class FileInfo(BaseModel):
+    id: int
+    file_name: str
+    file_content: str | None = None
+    context_mode: str | None = None
+    status: str | None = None
+    job_id: int | None = None
+
+class ChatQuery(BaseModel):
+    file_id: int
+    query: str
+    history: str = ""  
+
+
+class ChatResponse(BaseModel):
+    response: str
+
+
+class ConversationRecord(BaseModel):
+    id: int
+    role: str
+    content: str
+    timestamp: datetime
+
+
+class ConversationPage(BaseModel):
+    messages: list[ConversationRecord]
+    next_cursor: int | None = None
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+
+
+faq_cache = LRUCache(FAQ_CACHE_MAX_BYTES, sizeof=lambda chunks: sum(len(c) for c in chunks))
+
+
+class AnswerCache:
+    """Per-file answers keyed by query embedding, looked up by cosine similarity with TTL and LRU eviction.
+
+    Entries are grouped by a (file id, chunk version) key, so a re-indexed file stops matching answers for its
+    old content in every worker, not just the one that ran the ingestion job.
+    """
+
+    def __init__(self, threshold: float, ttl_seconds: int, max_entries: int):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.seeded = 0
+        self.evictions = 0
+        self._files: dict[tuple, OrderedDict] = {}
+        self._recency = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, file_key: tuple, query: str):
+        self._recency.pop((file_key, query), None)
+        entries = self._files.get(file_key)
+        if entries is not None:
+            entries.pop(query, None)
+            if not entries:
+                del self._files[file_key]
+
+    def lookup(self, file_key: tuple, vector) -> str | None:
+        query_vector = LocalVectorStore._normalize(vector)[0]
+        now = time.monotonic()
+        with self._lock:
+            entries = self._files.get(file_key, {})
+            for query in [q for q, (_, _, created) in entries.items() if now - created > self.ttl_seconds]:
+                self._drop(file_key, query)
+            entries = self._files.get(file_key)
+            if entries:
+                queries = list(entries)
+                scores = np.stack([entries[q][0] for q in queries]) @ query_vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    self._recency.move_to_end((file_key, queries[best]))
+                    return entries[queries[best]][1]
+            self.misses += 1
+            return None
+
+    def store(self, file_key: tuple, query: str, vector, answer: str):
+        with self._lock:
+            self._drop(file_key, query)
+            self._files.setdefault(file_key, OrderedDict())[query] = (LocalVectorStore._normalize(vector)[0], answer, time.monotonic())
+            self._recency[(file_key, query)] = None
+            while len(self._recency) > self.max_entries:
+                (old_file_key, old_query), _ = self._recency.popitem(last=False)
+                self._drop(old_file_key, old_query)
+                self.evictions += 1
+
+    def invalidate(self, file_id: int):
+        # Frees this process's entries for every version of the file; other workers stop matching them by version.
+        with self._lock:
+            for file_key in [key for key in self._files if key[0] == file_id]:
+                for query in list(self._files[file_key]):
+                    self._drop(file_key, query)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._recency),
+                "files": len(self._files),
+                "hits": self.hits,
+                "misses": self.misses,
+                "seeded_from_web_queries": self.seeded,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES)
+
+
+class EmbeddingCache:
+    """Embeddings stored as float32 blobs in SQLite, keyed by (model, task type, sha256 of the text)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Opened on first use under the lock, so importing the module never touches the disk.
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT, task_type TEXT, digest TEXT, vector BLOB, PRIMARY KEY (model, task_type, digest)"
+                ") WITHOUT ROWID"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, model: str, task_type: str, digests: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            for batch in batched(digests, 500):
+                rows = conn.execute(
+                    f"SELECT digest, vector FROM embeddings WHERE model = ? AND task_type = ? AND digest IN ({', '.join('?' * len(batch))})",
+                    (model, task_type, *batch),
+                )
+                for digest, blob in rows:
+                    found[digest] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, task_type: str, vectors: dict[str, list[float]]):
+        with self._lock, self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, task_type, digest, vector) VALUES (?, ?, ?, ?)",
+                [(model, task_type, digest, np.asarray(vector, dtype=np.float32).tobytes()) for digest, vector in vectors.items()],
+            )
+
+
+class EmbeddingService(Embeddings):
+    """Serves embeddings from the cache and coalesces concurrent misses into deduplicated batches.
+
+    Callers block on a future while a worker thread waits up to max_wait_ms for a batch to fill. Documents and
+    queries have a worker each, so a chat query is never queued behind an upload's document batches.
+    """
+
+    TASK_TYPES = {"document": "RETRIEVAL_DOCUMENT", "query": "RETRIEVAL_QUERY"}
+
+    def __init__(self, base_factory, model: str, cache: EmbeddingCache, max_batch: int, max_wait_ms: float):
+        self.base_factory = base_factory
+        self._base = None
+        self.model = model
+        self.cache = cache
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requested = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.embedded = 0
+        self.batches = 0
+        self._pending = {kind: [] for kind in self.TASK_TYPES}
+        self._inflight: dict[tuple[str, str], Future] = {}
+        self._cond = threading.Condition()
+        self._workers: dict[str, threading.Thread] = {}
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(list(texts), "document")
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text], "query")[0]
+
+    def _embed(self, texts: list[str], kind: str) -> list[list[float]]:
+        digests = [content_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, kind, list(set(digests)))
+        waiting = {}
+        with self._cond:
+            self.requested += len(texts)
+            self.cache_hits += sum(digest in vectors for digest in digests)
+            for text, digest in zip(texts, digests):
+                if digest in vectors or digest in waiting:
+                    continue
+                future = self._inflight.get((kind, digest))
+                if future is None:
+                    future = self._inflight[(kind, digest)] = Future()
+                    self._pending[kind].append((digest, text, future))
+                else:
+                    self.coalesced += 1
+                waiting[digest] = future
+            if waiting:
+                count_upstream("embed")
+                if kind not in self._workers:
+                    self._workers[kind] = threading.Thread(target=self._run, args=(kind,), name=f"embedding-batcher-{kind}", daemon=True)
+                    self._workers[kind].start()
+                self._cond.notify_all()
+        for digest, future in waiting.items():
+            vectors[digest] = future.result()
+        return [vectors[digest] for digest in digests]
+
+    def _run(self, kind: str):
+        pending = self._pending[kind]
+        while True:
+            with self._cond:
+                while not pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.max_wait
+                while len(pending) < self.max_batch and (remaining := deadline - time.monotonic()) > 0:
+                    self._cond.wait(remaining)
+                batch = pending[:self.max_batch]
+                del pending[:self.max_batch]
+            self._flush(kind, batch)
+
+    def _flush(self, kind: str, batch: list[tuple[str, str, Future]]):
+        try:
+            vectors = self.base.embed_documents([text for _, text, _ in batch], task_type=self.TASK_TYPES[kind])
+            self.cache.put_many(self.model, kind, {digest: vector for (digest, _, _), vector in zip(batch, vectors)})
+        except Exception as e:
+            vectors = None
+            error = e
+        with self._cond:
+            self.batches += 1
+            if vectors is not None:
+                self.embedded += len(batch)
+            for digest, _, _ in batch:
+                self._inflight.pop((kind, digest), None)
+        for i, (_, _, future) in enumerate(batch):
+            if vectors is None:
+                future.set_exception(error)
+            else:
+                future.set_result(vectors[i])
+
+    @property
+    def base(self):
+        # Built on the first batch, so importing the module never touches the embeddings SDK.
+        with self._cond:
+            if self._base is None:
+                self._base = self.base_factory()
+            return self._base
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "requested": self.requested,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced,
+                "embedded": self.embedded,
+                "batches": self.batches,
+                "hit_rate": round(self.cache_hits / self.requested, 4) if self.requested else 0.0,
+            }
+
+
+def create_base_embeddings():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+
+
+embeddings = EmbeddingService(create_base_embeddings, EMBEDDING_MODEL, EmbeddingCache(EMBEDDING_CACHE_PATH), EMBED_MAX_BATCH, EMBED_MAX_WAIT_MS)
+
+
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+vector_semaphore = asyncio.Semaphore(VECTOR_CONCURRENCY)
+web_semaphore = asyncio.Semaphore(WEB_CONCURRENCY)
+# Cancelling a task releases web_semaphore while its thread keeps running, so the threads hold a slot of their own.
+web_thread_slots = threading.BoundedSemaphore(WEB_CONCURRENCY)
+embed_semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+
+stream_events: ContextVar[asyncio.Queue | None] = ContextVar("stream_events", default=None)
+# The branch the current chat turn took, so the answer cache can skip turns that only make sense with their history.
+current_branch: ContextVar[str | None] = ContextVar("current_branch", default=None)
+
+
+class Metrics:
+    """In-process Prometheus counters and histograms, rendered in the text exposition format."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    HELP = {
+        "faq_chat_request_seconds": ("histogram", "Chat request latency by answer branch."),
+        "faq_chat_stage_seconds": ("histogram", "Chat pipeline stage latency."),
+        "faq_upstream_calls_total": ("counter", "Upstream calls made by chat requests."),
+        "faq_llm_tokens_total": ("counter", "Estimated prompt and response tokens sent to and received from the model."),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple, list] = {}
+        self._counters: dict[tuple, float] = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(labels, **extra) -> str:
+        pairs = list(labels) + list(extra.items())
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self.HELP.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                if kind == "counter":
+                    for (metric, labels), value in sorted(self._counters.items()):
+                        if metric == name:
+                            lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                for (metric, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(self.BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {round(total, 6)}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Trace:
+    """Timings, upstream call counts and token sizes for one chat request."""
+
+    def __init__(self, endpoint: str):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.endpoint = endpoint
+        self.branch = "unknown"
+        self.stages: dict[str, list] = {}
+        self.upstream: dict[str, int] = {}
+        self.tokens = {"prompt": 0, "response": 0}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+        metrics.observe("faq_chat_stage_seconds", seconds, stage=stage)
+
+    def add_upstream(self, kind: str, prompt_tokens: int = 0, response_tokens: int = 0):
+        with self._lock:
+            self.upstream[kind] = self.upstream.get(kind, 0) + 1
+            self.tokens["prompt"] += prompt_tokens
+            self.tokens["response"] += response_tokens
+
+    def finish(self, status: str):
+        seconds = time.perf_counter() - self.started
+        metrics.observe("faq_chat_request_seconds", seconds, branch=self.branch)
+        for kind, count in self.upstream.items():
+            metrics.inc("faq_upstream_calls_total", count, kind=kind)
+        for direction, count in self.tokens.items():
+            metrics.inc("faq_llm_tokens_total", count, direction=direction)
+        trace_logger.info(json.dumps({
+            "event": "chat_trace",
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            "status": status,
+            "branch": self.branch,
+            "duration_ms": round(seconds * 1000, 1),
+            "stages_ms": {stage: round(total * 1000, 1) for stage, (total, _) in self.stages.items()},
+            "upstream_calls": self.upstream,
+            "tokens": self.tokens,
+        }))
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def request_trace(endpoint: str):
+    if not TRACING_ENABLED:
+        yield None
+        return
+    trace = Trace(endpoint)
+    token = current_trace.set(trace)
+    status = "ok"
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        current_trace.reset(token)
+        trace.finish(status)
+
+
+def traced(stage: str):
+    """Record the wrapped function's wall time under stage when a request trace is active."""
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                trace = current_trace.get()
+                if trace is None:
+                    return await fn(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    trace.add_stage(stage, time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                trace.add_stage(stage, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def count_upstream(kind: str, prompt_tokens: int = 0, response_tokens: int = 0):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_upstream(kind, prompt_tokens, response_tokens)
+
+
+def tag_branch(branch: str):
+    current_branch.set(branch)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.branch = branch
+
+
+async def generate(model, prompt: str) -> str:
+    async with llm_semaphore:
+        response = await model.generate_content_async(prompt)
+    count_upstream("llm", estimate_tokens(prompt), estimate_tokens(response.text))
+    return response.text
+
+
+async def generate_answer(model, prompt: str) -> str:
+    # Final answers are streamed token by token when the request came through /chat/query/stream.
+    queue = stream_events.get()
+    if queue is None:
+        return await generate(model, prompt)
+    await report_stage("answer")
+    parts = []
+    async with llm_semaphore:
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            parts.append(chunk.text)
+            await queue.put(("token", {"text": chunk.text}))
+    answer = "".join(parts)
+    count_upstream("llm", estimate_tokens(prompt), estimate_tokens(answer))
+    return answer
+
+
+async def report_stage(stage: str):
+    queue = stream_events.get()
+    if queue is not None:
+        await queue.put(("stage", {"stage": stage}))
+
+
+async def run_blocking(kind: str, semaphore: asyncio.Semaphore, fn, *args, **kwargs):
+    # Sync SDK calls (Pinecone, phi, PyPDF2) run in worker threads so they never stall the event loop.
+    count_upstream(kind)
+    async with semaphore:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+@functools.cache
+def load_genai():
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai
+
+
+def create_generative_model(**kwargs):
+    return load_genai().GenerativeModel(**kwargs)
+
+
+def create_pinecone_client(api_key: str):
+    from pinecone import Pinecone
+    return Pinecone(api_key=api_key)
+
+
+def create_pinecone_store(index, embedding):
+    from langchain_pinecone import PineconeVectorStore
+    return PineconeVectorStore(index=index, embedding=embedding)
+
+
+def create_search_tools():
+    from phi.tools.duckduckgo import DuckDuckGo
+    from phi.tools.serpapi_tools import SerpApiTools
+    return DuckDuckGo(), SerpApiTools(api_key=SERPAPI_API_KEY)
+
+
+def create_web_agent():
+    from phi.agent import Agent
+    from phi.model.google import Gemini
+    from phi.tools.website import WebsiteTools
+    return Agent(
+        model=Gemini(model=CHAT_MODEL, api_key=GOOGLE_API_KEY),
+        tools=[*create_search_tools(), WebsiteTools()],
+        instructions=["Search the web for the most relevant and accurate information to answer the question briefly. Do not ask follow-up questions."]
+    )
+
+
+class ClientRegistry:
+    """Process-wide upstream clients, reused across requests so their connection pools stay warm."""
+
+    def __init__(self, max_clients: int, index_list_ttl: int, agent_pool_size: int):
+        self.max_clients = max_clients
+        self.index_list_ttl = index_list_ttl
+        self._lock = threading.Lock()
+        self._pinecone = OrderedDict()
+        self._indexes = OrderedDict()
+        self._index_names: dict[str, tuple[set[str], float]] = {}
+        self._models = {}
+        self._agents = queue.Queue(maxsize=agent_pool_size)
+        self._search_tools = None
+
+    def _remember(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        while len(cache) > self.max_clients:
+            cache.popitem(last=False)
+
+    def pinecone(self, api_key: str):
+        key = content_hash(api_key)
+        with self._lock:
+            client = self._pinecone.get(key)
+            if client is None:
+                client = create_pinecone_client(api_key)
+                self._remember(self._pinecone, key, client)
+            self._pinecone.move_to_end(key)
+            return client
+
+    def index(self, api_key: str, index_name: str):
+        key = (content_hash(api_key), index_name)
+        with self._lock:
+            index = self._indexes.get(key)
+        if index is None:
+            index = self.pinecone(api_key).Index(index_name)
+            with self._lock:
+                self._remember(self._indexes, key, index)
+        return index
+
+    def index_names(self, api_key: str) -> set[str]:
+        key = content_hash(api_key)
+        with self._lock:
+            cached = self._index_names.get(key)
+        if cached and time.monotonic() - cached[1] < self.index_list_ttl:
+            return cached[0]
+        names = {i['name'] for i in self.pinecone(api_key).list_indexes()}
+        with self._lock:
+            self._index_names[key] = (names, time.monotonic())
+        return names
+
+    def add_index_name(self, api_key: str, index_name: str):
+        with self._lock:
+            cached = self._index_names.get(content_hash(api_key))
+            if cached:
+                cached[0].add(index_name)
+
+    def model(self, system_instruction: str | None = None, response_mime_type: str | None = None, model_name: str = CHAT_MODEL):
+        key = (model_name, system_instruction, response_mime_type)
+        with self._lock:
+            if key not in self._models:
+                generation_config = {"response_mime_type": response_mime_type} if response_mime_type else None
+                self._models[key] = create_generative_model(model_name=model_name, system_instruction=system_instruction, generation_config=generation_config)
+            return self._models[key]
+
+    def search_tools(self) -> tuple:
+        with self._lock:
+            if self._search_tools is None:
+                self._search_tools = create_search_tools()
+            return self._search_tools
+
+    @contextmanager
+    def web_agent(self):
+        # phi agents keep per-run state, so each one serves a single search at a time and is reset before reuse.
+        try:
+            agent = self._agents.get_nowait()
+        except queue.Empty:
+            agent = create_web_agent()
+        try:
+            yield agent
+        finally:
+            agent.memory.clear()
+            try:
+                self._agents.put_nowait(agent)
+            except queue.Full:
+                pass
+
+
+clients = ClientRegistry(CLIENT_CACHE_SIZE, INDEX_LIST_TTL_SECONDS, WEB_CONCURRENCY)
+
+
+class LocalVectorStore:
+    """File-backed vector index: per namespace, an append-only float32 matrix plus a JSONL record log."""
+
+    def __init__(self, index_name: str, embedding, root: str = LOCAL_VECTOR_DIR):
+        self.index_dir = os.path.join(root, index_name)
+        self.embedding = embedding
+        self._lock = threading.Lock()
+        self._loaded = {}
+
+    def _paths(self, namespace: str | None) -> tuple[str, str]:
+        ns_dir = os.path.join(self.index_dir, re.sub("[^A-Za-z0-9_-]", "_", namespace or "default"))
+        return os.path.join(ns_dir, "vectors.f32"), os.path.join(ns_dir, "records.jsonl")
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def add_texts(self, texts: list[str], metadatas: list[dict] | None = None, namespace: str | None = None, ids: list[str] | None = None, **kwargs) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        metadatas = list(metadatas) if metadatas else [None] * len(texts)
+        matrix = self._normalize(self.embedding.embed_documents(texts))
+        vectors_path, records_path = self._paths(namespace)
+        with self._lock:
+            os.makedirs(os.path.dirname(vectors_path), exist_ok=True)
+            with open(vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(records_path, "a", encoding="utf-8") as f:
+                for vector_id, text, metadata in zip(ids, texts, metadatas):
+                    record = {"id": vector_id, "text": text, "metadata": metadata} if metadata else {"id": vector_id, "text": text}
+                    f.write(json.dumps(record) + "\n")
+            self._loaded.pop(namespace, None)
+        return ids
+
+    def delete(self, ids: list[str], namespace: str | None = None, **kwargs):
+        _, records_path = self._paths(namespace)
+        with self._lock:
+            os.makedirs(os.path.dirname(records_path), exist_ok=True)
+            with open(records_path, "a", encoding="utf-8") as f:
+                for vector_id in ids:
+                    f.write(json.dumps({"id": vector_id, "deleted": True}) + "\n")
+            self._loaded.pop(namespace, None)
+
+    @staticmethod
+    def _signature(path: str) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load(self, namespace: str | None):
+        vectors_path, records_path = self._paths(namespace)
+        # Other worker processes append to the same files, so a cached namespace is reused only while both are unchanged.
+        signature = (self._signature(vectors_path), self._signature(records_path))
+        with self._lock:
+            cached = self._loaded.get(namespace)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            # delete() can write a records log before any vectors exist, so either file may be missing.
+            if signature[1] is None or signature[0] is None or not signature[0][0]:
+                loaded = (np.zeros((0, EMBEDDING_DIM), dtype=np.float32), [])
+            else:
+                # Another process may be part-way through an append, so only whole rows that have a record are read.
+                rows = signature[0][0] // (EMBEDDING_DIM * 4)
+                matrix = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, EMBEDDING_DIM))
+                latest = {}
+                row = 0
+                with open(records_path, encoding="utf-8") as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if record.get("deleted"):
+                            latest.pop(record["id"], None)
+                            continue
+                        latest[record["id"]] = (row, record["text"], record.get("metadata") or {})
+                        row += 1
+                ordered = sorted(((vector_id, entry) for vector_id, entry in latest.items() if entry[0] < rows), key=lambda item: item[1][0])
+                live = np.array([entry[0] for _, entry in ordered], dtype=np.int64)
+                records = [(vector_id, text, metadata) for vector_id, (_, text, metadata) in ordered]
+                loaded = (matrix[live] if len(live) != matrix.shape[0] else matrix, records)
+            self._loaded[namespace] = (signature, loaded)
+            return loaded
+
+    def batch_similarity_search_with_score(self, queries: list[str], k: int = 4, namespace: str | None = None) -> list[list[tuple[Document, float]]]:
+        if not queries:
+            return []
+        return self.batch_similarity_search_by_vector_with_score([self.embedding.embed_query(q) for q in queries], k=k, namespace=namespace)
+
+    def batch_similarity_search_by_vector_with_score(self, vectors, k: int = 4, namespace: str | None = None) -> list[list[tuple[Document, float]]]:
+        matrix, records = self._load(namespace)
+        if not records:
+            return [[] for _ in vectors]
+        query_matrix = self._normalize(vectors)
+        scores = query_matrix @ matrix.T
+        k = min(k, len(records))
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([
+                (Document(page_content=records[i][1], metadata={"id": records[i][0], **records[i][2]}), float(row[i]))
+                for i in top
+            ])
+        return results
+
+    def similarity_search_by_vector_with_score(self, embedding: list[float], k: int = 4, namespace: str | None = None, **kwargs) -> list[tuple[Document, float]]:
+        return self.batch_similarity_search_by_vector_with_score([embedding], k=k, namespace=namespace)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, namespace: str | None = None, **kwargs) -> list[tuple[Document, float]]:
+        return self.batch_similarity_search_with_score([query], k=k, namespace=namespace)[0]
+
+    def similarity_search(self, query: str, k: int = 4, namespace: str | None = None, **kwargs) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, namespace=namespace)]
+
+
+class PineconeBackend:
+    def __init__(self, api_key: str):
+        if not api_key:
+            raise HTTPException(status_code=400, detail="A Pinecone API key is required.")
+        self.api_key = api_key
+        self.pc = clients.pinecone(api_key)
+
+    def ensure_index(self, index_name: str):
+        if index_name not in clients.index_names(self.api_key):
+            from pinecone import ServerlessSpec
+            self.pc.create_index(
+                name=index_name,
+                dimension=EMBEDDING_DIM,
+                metric='cosine',
+                spec=ServerlessSpec(cloud='aws', region='us-east-1'),
+            )
+            clients.add_index_name(self.api_key, index_name)
+
+    def get_store(self, index_name: str):
+        return create_pinecone_store(clients.index(self.api_key, index_name), embeddings)
+
+
+_local_stores: dict[str, LocalVectorStore] = {}
+_local_stores_lock = threading.Lock()
+
+
+class LocalBackend:
+    def __init__(self, owner_id: int):
+        self.owner_id = owner_id
+
+    def _index_path(self, index_name: str) -> str:
+        # Index names come from file names, so each owner gets their own directory to keep users' chunks apart.
+        return os.path.join(f"user-{self.owner_id}", index_name)
+
+    def ensure_index(self, index_name: str):
+        os.makedirs(os.path.join(LOCAL_VECTOR_DIR, self._index_path(index_name)), exist_ok=True)
+
+    def get_store(self, index_name: str) -> LocalVectorStore:
+        index_path = self._index_path(index_name)
+        with _local_stores_lock:
+            if index_path not in _local_stores:
+                _local_stores[index_path] = LocalVectorStore(index_path, embeddings)
+            return _local_stores[index_path]
+
+
+def get_vector_backend(pinecone_api_key: str, owner_id: int):
+    if VECTOR_BACKEND == "local":
+        return LocalBackend(owner_id)
+    return PineconeBackend(pinecone_api_key)
+
+
+def sanitize_file_name(file_name: str) -> str:
+    sanitized_name = re.sub('[^a-z0-9-]', '', file_name.strip().lower().replace(" ", "-"))
+    return f"faq-{sanitized_name}"
+
+
+def split_paragraphs(text: str) -> list[str]:
+    return [chunk.strip() for chunk in text.split("\n\n") if chunk.strip()]
+
+
+def iter_json_texts(fileobj):
+    for item in json.load(io.TextIOWrapper(fileobj, encoding="utf-8")):
+        yield f"Q: {item['question']}\nA: {item['answer']}"
+
+
+def iter_txt_pieces(fileobj):
+    yield from io.TextIOWrapper(fileobj, encoding="utf-8")
+
+
+def iter_pdf_pieces(fileobj):
+    import PyPDF2
+    for page in PyPDF2.PdfReader(fileobj).pages:
+        yield (page.extract_text() or "") + "\n"
+
+
+def iter_docx_pieces(fileobj):
+    import docx
+    for i, para in enumerate(docx.Document(fileobj).paragraphs):
+        yield ("\n" if i else "") + para.text
+
+
+def window_text(text: str, max_chars: int = CHUNK_MAX_CHARS, overlap: int = CHUNK_OVERLAP_CHARS):
+    """Yield (chunk, embed_text) pairs; an oversized text is split and its windows overlap only in embed_text."""
+    if len(text) <= max_chars:
+        yield text, text
+        return
+    step = max(1, max_chars - overlap)
+    for start in range(0, len(text), step):
+        yield text[start:start + step], text[max(0, start - overlap):start + step]
+
+
+def iter_chunks(pieces, max_chars: int = CHUNK_MAX_CHARS, overlap: int = CHUNK_OVERLAP_CHARS):
+    """Streaming version of window_text over blank-line paragraphs; holds at most one window of text."""
+    step = max(1, max_chars - overlap)
+    buffer = ""
+    tail = ""
+    for piece in chain(pieces, [None]):
+        if piece is not None:
+            buffer += piece
+        while True:
+            end = buffer.find("\n\n", 0, max_chars + 2)
+            if end == -1 and piece is None:
+                end = len(buffer)
+            if end != -1:
+                paragraph, buffer = buffer[:end], buffer[end + 2:]
+                if tail and paragraph.strip():
+                    yield paragraph, tail + paragraph
+                elif paragraph.strip():
+                    yield paragraph.strip(), paragraph.strip()
+                tail = ""
+                if piece is None and not buffer:
+                    break
+            elif len(buffer) > max_chars:
+                window, buffer = buffer[:step], buffer[step:]
+                yield window, tail + window
+                tail = window[-overlap:] if overlap else ""
+            else:
+                break
+
+
+def iter_document_chunks(fileobj, file_ext: str):
+    if file_ext == ".json":
+        return (chunk for text in iter_json_texts(fileobj) for chunk in window_text(text))
+    elif file_ext == ".txt":
+        return iter_chunks(iter_txt_pieces(fileobj))
+    elif file_ext == ".pdf":
+        return iter_chunks(iter_pdf_pieces(fileobj))
+    elif file_ext == ".docx":
+        return iter_chunks(iter_docx_pieces(fileobj))
+    raise HTTPException(status_code=400, detail="Unsupported file type.")
+
+
+def batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def add_timing(timings: dict, stage: str, started: float):
+    timings[stage] = round(timings.get(stage, 0.0) + time.perf_counter() - started, 4)
+
+
+def chunk_vector_id(file_id: int, embed_text: str) -> str:
+    return f"{file_id}-{content_hash(embed_text)}"
+
+
+def ingest_document(fileobj, file_ext: str, vector_store, db: Session, file_id: int, indexed_ids: set[str] = frozenset(), on_progress=None, timings: dict | None = None) -> tuple[int, set[str]]:
+    """Parse, chunk, embed and store a document in fixed-size batches so memory stays flat.
+
+    Only chunks whose vector id is not in indexed_ids are embedded. Returns the chunk count and the vector ids the document uses.
+    """
+    timings = {} if timings is None else timings
+    batches = batched(iter_document_chunks(fileobj, file_ext), EMBED_BATCH_SIZE)
+    chunk_count = 0
+    document_ids = set()
+    while True:
+        started = time.perf_counter()
+        batch = next(batches, None)
+        add_timing(timings, "parse", started)
+        if batch is None:
+            return chunk_count, document_ids
+        vector_ids = [chunk_vector_id(file_id, embed_text) for _, embed_text in batch]
+        new_texts, new_ids = [], []
+        for (_, embed_text), vector_id in zip(batch, vector_ids):
+            if vector_id not in indexed_ids and vector_id not in document_ids:
+                new_texts.append(embed_text)
+                new_ids.append(vector_id)
+            document_ids.add(vector_id)
+        started = time.perf_counter()
+        if new_texts:
+            vector_store.add_texts(new_texts, ids=new_ids)
+        add_timing(timings, "embed_upsert", started)
+        started = time.perf_counter()
+        store_faq_chunks(db, file_id, [chunk for chunk, _ in batch], start=chunk_count, vector_ids=vector_ids)
+        add_timing(timings, "store", started)
+        chunk_count += len(batch)
+        if on_progress:
+            on_progress(chunk_count)
+
+
+ingestion_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+# Identifies this process as the owner of the jobs it queues; the owner renews their heartbeat while it is alive.
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def indexed_vector_ids(db: Session, file_id: int, base_chunk_id: int) -> set[str]:
+    rows = db.query(FileChunk.vector_id).filter(FileChunk.file_id == file_id, FileChunk.id <= base_chunk_id, FileChunk.vector_id.isnot(None))
+    return {row.vector_id for row in rows}
+
+
+def discard_new_chunks(db: Session, file_id: int, base_chunk_id: int, vector_store=None):
+    """Drop the chunks a job stored after base_chunk_id, and their vectors when the store is available."""
+    new_rows = db.query(FileChunk).filter(FileChunk.file_id == file_id, FileChunk.id > base_chunk_id)
+    if vector_store is not None:
+        stale = {row.vector_id for row in new_rows.with_entities(FileChunk.vector_id)} - indexed_vector_ids(db, file_id, base_chunk_id)
+        for batch in batched(stale, EMBED_BATCH_SIZE):
+            vector_store.delete(ids=batch)
+    new_rows.delete(synchronize_session=False)
+
+
+def run_ingestion_job(job_id: int, pinecone_api_key: str = ""):
+    with SessionLocal() as db:
+        job = db.get(IngestionJob, job_id)
+        file_rec = db.get(FileRecord, job.file_id)
+        timings = {}
+
+        def update_job(**fields):
+            for key, value in fields.items():
+                setattr(job, key, value)
+            job.stage_timings = json.dumps(timings)
+            job.updated_at = datetime.utcnow()
+            db.commit()
+
+        # Chunks up to base_chunk_id are the previously indexed version; the job's own chunks are stored after them.
+        if job.base_chunk_id is None:
+            job.base_chunk_id = db.query(func.max(FileChunk.id)).filter(FileChunk.file_id == file_rec.id).scalar() or 0
+        vector_store = None
+        try:
+            # A job resumed after a restart starts over; its vector ids are stable, so re-upserting them is harmless.
+            discard_new_chunks(db, file_rec.id, job.base_chunk_id)
+            # Commit the delete before any Pinecone call, so SQLite's write lock is not held while an index is created.
+            update_job(status="running", stage="index", chunk_count=0)
+            vector_backend = get_vector_backend(pinecone_api_key, file_rec.user_id)
+            started = time.perf_counter()
+            vector_backend.ensure_index(file_rec.pinecone_index)
+            vector_store = vector_backend.get_store(file_rec.pinecone_index)
+            add_timing(timings, "index", started)
+            update_job(stage="ingest")
+            indexed_ids = indexed_vector_ids(db, file_rec.id, job.base_chunk_id)
+            with open(job.upload_path, "rb") as fileobj:
+                chunk_count, document_ids = ingest_document(
+                    fileobj, job.file_ext, vector_store, db, file_rec.id, indexed_ids=indexed_ids,
+                    on_progress=lambda done: update_job(chunk_count=done), timings=timings,
+                )
+            update_job(stage="cleanup")
+            started = time.perf_counter()
+            removed_ids = indexed_ids - document_ids
+            for batch in batched(removed_ids, EMBED_BATCH_SIZE):
+                vector_store.delete(ids=batch)
+            db.query(FileChunk).filter(FileChunk.file_id == file_rec.id, FileChunk.id <= job.base_chunk_id).delete(synchronize_session=False)
+            faq_cache.pop((file_rec.id, file_rec.live_chunk_id))
+            file_rec.live_chunk_id = db.query(func.max(FileChunk.id)).filter(FileChunk.file_id == file_rec.id).scalar() or 0
+            add_timing(timings, "cleanup", started)
+            file_rec.status = "ready"
+            file_rec.file_content = None
+            update_job(
+                status="completed", stage="done", chunk_count=chunk_count,
+                chunks_added=len(document_ids - indexed_ids),
+                chunks_unchanged=len(document_ids & indexed_ids),
+                chunks_removed=len(removed_ids),
+            )
+            invalidate_file_summaries(db, file_rec.user_id, file_rec.pinecone_index)
+        except Exception as e:
+            logger.exception("Ingestion job %s failed", job_id)
+            db.rollback()
+            try:
+                discard_new_chunks(db, file_rec.id, job.base_chunk_id, vector_store)
+            except Exception:
+                logger.exception("Could not remove vectors stored by ingestion job %s", job_id)
+                discard_new_chunks(db, file_rec.id, job.base_chunk_id)
+            # A failed re-upload leaves the previously indexed version in place.
+            file_rec.status = "ready" if job.base_chunk_id or file_rec.file_content else "failed"
+            update_job(status="failed", error=getattr(e, "detail", None) or str(e))
+        finally:
+            if job.upload_path and os.path.exists(job.upload_path):
+                os.remove(job.upload_path)
+
+
+def renew_ingestion_leases():
+    with SessionLocal() as db:
+        db.query(IngestionJob).filter(
+            IngestionJob.worker_id == WORKER_ID, IngestionJob.status.in_(["queued", "running"])
+        ).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+
+
+def resume_ingestion_jobs():
+    """Take over unfinished jobs whose owning worker stopped renewing their heartbeat."""
+    stale = or_(IngestionJob.heartbeat_at.is_(None), IngestionJob.heartbeat_at < datetime.utcnow() - timedelta(seconds=INGEST_LEASE_SECONDS))
+    unfinished = IngestionJob.status.in_(["queued", "running"])
+    with SessionLocal() as db:
+        for (job_id,) in db.query(IngestionJob.id).filter(unfinished, stale).all():
+            # The conditional update is the claim: when several workers start at once, only one of them gets the job.
+            claimed = db.query(IngestionJob).filter(IngestionJob.id == job_id, unfinished, stale).update(
+                {"worker_id": WORKER_ID, "heartbeat_at": datetime.utcnow()}, synchronize_session=False
+            )
+            db.commit()
+            if not claimed:
+                continue
+            job = db.get(IngestionJob, job_id)
+            if VECTOR_BACKEND == "local" and job.upload_path and os.path.exists(job.upload_path):
+                job.status = "queued"
+                db.commit()
+                ingestion_executor.submit(run_ingestion_job, job.id)
+            else:
+                # Pinecone keys are never persisted, so these jobs cannot be resumed.
+                job.status = "failed"
+                job.error = "Interrupted by a server restart. Please upload the file again."
+                job.updated_at = datetime.utcnow()
+                discard_new_chunks(db, job.file_id, job.base_chunk_id or 0)
+                file_status = "ready" if job.base_chunk_id else "failed"
+                db.query(FileRecord).filter(FileRecord.id == job.file_id).update({"status": file_status})
+                db.commit()
+
+
+def maintain_ingestion_jobs(stop: threading.Event):
+    # Renews this worker's leases and picks up jobs left behind by workers that died while the rest keep running.
+    while not stop.wait(INGEST_LEASE_SECONDS / 4):
+        try:
+            renew_ingestion_leases()
+            resume_ingestion_jobs()
+        except Exception:
+            logger.exception("Could not maintain ingestion job leases")
+
+
+def job_info(job: IngestionJob) -> dict:
+    return {
+        "id": job.id,
+        "file_id": job.file_id,
+        "status": job.status,
+        "stage": job.stage,
+        "chunk_count": job.chunk_count or 0,
+        "chunks_added": job.chunks_added or 0,
+        "chunks_unchanged": job.chunks_unchanged or 0,
+        "chunks_removed": job.chunks_removed or 0,
+        "stage_timings": json.loads(job.stage_timings or "{}"),
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+
+def chunks_from_file_content(file_content: str) -> list[str]:
+    try:
+        faq_data = json.loads(file_content)
+        return [f"Q: {item['question']}\nA: {item['answer']}" for item in faq_data]
+    except (ValueError, TypeError, KeyError):
+        return split_paragraphs(file_content)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def truncate_to_budget(text: str, token_budget: int) -> str:
+    max_chars = token_budget * 4
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+def fit_to_budget(chunks: list[str], token_budget: int) -> list[str]:
+    selected = []
+    used = 0
+    for chunk in chunks:
+        cost = estimate_tokens(chunk)
+        if used + cost > token_budget:
+            break
+        selected.append(chunk)
+        used += cost
+    return selected
+
+
+async def retrieve_context(vector_store, query: str, fallback_chunks: list[str]) -> str:
+    await report_stage("retrieval")
+    docs = await run_blocking("vector", vector_semaphore, vector_store.similarity_search, query, k=RETRIEVAL_TOP_K)
+    chunks = [doc.page_content for doc in docs] or fallback_chunks
+    return "\n".join(fit_to_budget(chunks, CONTEXT_TOKEN_BUDGET))
+
+
+def validate_context_mode(context_mode: str) -> str:
+    if context_mode not in CONTEXT_MODES:
+        raise HTTPException(status_code=400, detail=f"context_mode must be one of: {', '.join(CONTEXT_MODES)}")
+    return context_mode
+
+
+def store_faq_chunks(db: Session, file_id: int, faq_texts: list[str], start: int = 0, vector_ids: list[str] | None = None):
+    if faq_texts:
+        vector_ids = vector_ids or [None] * len(faq_texts)
+        db.execute(FileChunk.__table__.insert(), [
+            {"file_id": file_id, "position": start + i, "text": text, "vector_id": vector_id}
+            for i, (text, vector_id) in enumerate(zip(faq_texts, vector_ids))
+        ])
+
+
+@traced("chunks")
+def get_faq_chunks(db: Session, file_rec: FileRecord) -> list[str]:
+    # Keyed by chunk version, so a worker picks up a re-index done by another worker on its next read.
+    cache_key = (file_rec.id, file_rec.live_chunk_id)
+    chunks = faq_cache.get(cache_key)
+    if chunks is not None:
+        return chunks
+    rows = db.query(FileChunk.text).filter(FileChunk.file_id == file_rec.id)
+    if file_rec.live_chunk_id is not None:
+        # A re-index in progress stores its chunks after the live ones; they are only read once the job completes.
+        rows = rows.filter(FileChunk.id <= file_rec.live_chunk_id)
+    chunks = [row.text for row in rows.order_by(FileChunk.position)]
+    if not chunks and file_rec.file_content:
+        # Files uploaded before chunks were stored locally are backfilled once from their content.
+        chunks = chunks_from_file_content(file_rec.file_content)
+        if file_rec.status != "processing":
+            store_faq_chunks(db, file_rec.id, chunks)
+            db.commit()
+    faq_cache.put(cache_key, chunks)
+    return chunks
+
+
+async def modify_query_for_web(query: str, context: str) -> str:
+    mod_model = clients.model()
+    mod_prompt = f"""
+    Given the FAQ Context: {context}
+    And the user query: {query}
+    Extract only the essential part of the query necessary for a web search.
+    Provide a concise modified query focusing on key terms.
+    """
+    mod_response = await generate(mod_model, mod_prompt)
+    return mod_response.strip()
+
+
+class WebAnswerCache:
+    """Web answers keyed by file and normalized query, persisted in the database and expired after a TTL."""
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+    def key(self, file_id: int, query: str) -> str:
+        # Answers are scoped to the file, as the same question can mean something different for another document.
+        return f"{file_id}:{self.normalize(query)}"
+
+    def record(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, file_id: int, query: str) -> str | None:
+        with SessionLocal() as db:
+            row = db.query(WebSearchResult).filter(WebSearchResult.query_key == self.key(file_id, query)).first()
+        if row is None:
+            self.record("misses")
+            return None
+        if (datetime.utcnow() - row.created_at).total_seconds() > self.ttl_seconds:
+            self.record("expired")
+            self.record("misses")
+            return None
+        self.record("hits")
+        return row.answer
+
+    def put(self, file_id: int, query: str, answer: str):
+        query_key = self.key(file_id, query)
+        with SessionLocal() as db:
+            row = db.query(WebSearchResult).filter(WebSearchResult.query_key == query_key).first()
+            if row is None:
+                db.add(WebSearchResult(file_id=file_id, query_key=query_key, query=query, answer=answer))
+            else:
+                row.query = query
+                row.answer = answer
+                row.created_at = datetime.utcnow()
+            db.commit()
+
+    def stats(self) -> dict:
+        with SessionLocal() as db:
+            entries = db.query(func.count(WebSearchResult.id)).scalar()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+web_cache = WebAnswerCache(WEB_CACHE_TTL_SECONDS)
+
+
+def search_duckduckgo(query: str) -> str:
+    duckduckgo, _ = clients.search_tools()
+    results = json.loads(duckduckgo.duckduckgo_search(query, max_results=WEB_MAX_RESULTS))
+    return "\n".join(f"{r.get('title', '')}: {r.get('body', '')} ({r.get('href', '')})" for r in results)
+
+
+def search_serpapi(query: str) -> str:
+    if not SERPAPI_API_KEY:
+        return ""
+    _, serpapi = clients.search_tools()
+    try:
+        # Failures come back as plain-text messages rather than JSON.
+        results = json.loads(serpapi.search_google(query, num_results=WEB_MAX_RESULTS))
+    except ValueError:
+        return ""
+    lines = [f"{r.get('title', '')}: {r.get('snippet', '')} ({r.get('link', '')})" for r in results.get("search_results") or []]
+    knowledge_graph = results.get("knowledge_graph")
+    if isinstance(knowledge_graph, dict) and knowledge_graph.get("description"):
+        lines.insert(0, f"{knowledge_graph.get('title', '')}: {knowledge_graph['description']}")
+    return "\n".join(lines)
+
+
+def in_web_slot(fn, *args):
+    with web_thread_slots:
+        return fn(*args)
+
+
+async def fan_out_search(query: str) -> str:
+    """Query the search APIs in parallel and return the first non-empty result set."""
+    tasks = [asyncio.ensure_future(run_blocking("web", web_semaphore, in_web_slot, search, query)) for search in (search_duckduckgo, search_serpapi)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                results = await next_done
+            except Exception:
+                logger.warning("Web search failed for %r", query, exc_info=True)
+                continue
+            if results.strip():
+                return results
+        return ""
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def run_web_agent(prompt: str) -> str:
+    # The agent is checked out inside the worker thread so a timed-out search still returns it to the pool when done.
+    with clients.web_agent() as serp_agent:
+        return serp_agent.run(prompt).get_content_as_string()
+
+
+async def search_web(search_query: str) -> str:
+    results = await fan_out_search(search_query)
+    if results:
+        return await generate(clients.model(), f"""
+        Answer the following question briefly using only the web search results below.
+        If the results do not contain the answer, say that you could not find it.
+        Question: {search_query}
+        Web Search Results: {results}
+        """)
+    # Neither search API returned anything, so let the agent search and browse on its own.
+    return await run_blocking("web", web_semaphore, in_web_slot, run_web_agent, f"Search the web and answer the following question: {search_query}")
+
+
+async def cached_web_search(file_id: int, query: str, refine=None) -> str:
+    # refine adds the file's context to the query, so it runs before the lookup and the refined query is the key.
+    search_query = await refine(query) if refine else query
+    cached = await asyncio.to_thread(web_cache.get, file_id, search_query)
+    if cached is not None:
+        return cached
+    answer = await search_web(search_query)
+    if answer.strip():
+        await asyncio.to_thread(web_cache.put, file_id, search_query, answer)
+    return answer
+
+
+@traced("web_search")
+async def get_web_answer(file_id: int, query: str, refine=None) -> str:
+    """Web answer for query about file_id; refine (an optional query rewriter), the cache lookup and the search share one time budget."""
+    await report_stage("web_search")
+    try:
+        return await asyncio.wait_for(cached_web_search(file_id, query, refine), WEB_SEARCH_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        web_cache.record("timeouts")
+        return ""
+    except Exception:
+        logger.exception("Web answer failed for %r", query)
+        web_cache.record("errors")
+        return ""
+
+
+async def gen_summary(text: str) -> str:
+    mo = clients.model(system_instruction="You are a detailed report generator from the FAQ context. Generate a very detailed analysis report on every detail of the given FAQ context.")
+    resp = await generate(mo, f"Provide a very detailed analysis report regarding everything about the details and information covered based on the given FAQ document context\nFAQ Context: {text}")
+    return resp
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_file_summary(file_id: int, digest: str) -> str | None:
+    with SessionLocal() as db:
+        cached = db.query(FileSummary).filter(FileSummary.file_id == file_id).first()
+        return cached.summary if cached and cached.content_hash == digest else None
+
+
+def write_file_summary(file_id: int, digest: str, summary: str):
+    with SessionLocal() as db:
+        cached = db.query(FileSummary).filter(FileSummary.file_id == file_id).first()
+        if cached:
+            cached.content_hash = digest
+            cached.summary = summary
+            cached.created_at = datetime.utcnow()
+        else:
+            db.add(FileSummary(file_id=file_id, content_hash=digest, summary=summary))
+        db.commit()
+
+
+@traced("summary")
+async def get_file_summary(file_id: int, faq_context: str, allow_generate: bool = True) -> str | None:
+    # Uses its own sessions so it can run as a task alongside the request's session.
+    digest = content_hash(faq_context)
+    summary = await asyncio.to_thread(read_file_summary, file_id, digest)
+    if summary is None and allow_generate:
+        await report_stage("summary")
+        summary = await gen_summary(faq_context)
+        await asyncio.to_thread(write_file_summary, file_id, digest, summary)
+    return summary
+
+
+def invalidate_file_summaries(db: Session, user_id: int, file_index: str):
+    file_ids = [f.id for f in db.query(FileRecord.id).filter(FileRecord.user_id == user_id, FileRecord.pinecone_index == file_index)]
+    for file_id in file_ids:
+        answer_cache.invalidate(file_id)
+    if file_ids:
+        db.query(FileSummary).filter(FileSummary.file_id.in_(file_ids)).delete(synchronize_session=False)
+        db.commit()
+
+
+@traced("satisfaction_check")
+async def is_unsatisfactory(web_answer: str) -> bool:
+    check_model = clients.model(
+        system_instruction="""You are a sentence classifier. Your task is to analyze each provided sentence and determine whether it is "satisfactory" or "not satisfactory" based on the following criteria:
+Satisfactory: The sentence conveys a positive meaning, includes clear and sufficient information, and directly provides the answer or solution.
+Not Satisfactory: The sentence either lacks enough information, explicitly states that it does not have the answer (e.g., "I don't have the answer"), or fails to address the query effectively."""
+    )
+    few_shot_prompt = f"""
+For each sentence, provide your classification along with a brief explanation of your reasoning.
+
+Example 1:
+Input Sentence: "The capital of France is Paris."
+Output: Satisfactory – because the sentence gives a clear and correct answer along with necessary information.
+
+Example 2:
+Input Sentence: "I don't have the answer."
+Output: Not Satisfactory – because it explicitly states a lack of an answer and provides no additional information.
+
+Example 3:
+Input Sentence: "I was unable to find the information regarding the data you requested."
+Output: Not Satisfactory – because it explicitly states a lack of an answer and provides no additional information.
+
+Example 4:
+Input Sentence: "The provided FAQ document does not contain information about who founded ShopTalk. Since I was unable to find the answer using web search, I cannot answer who is the founder of shoptalk."
+Output: Not Satisfactory – because it explicitly states a lack of an answer and provides no additional information.
+
+Now, please classify the following sentences:
+Sentences: "{web_answer}"
+"""
+    result = (await generate(check_model, few_shot_prompt)).lower().strip()
+    return "unsatisfactory" in result
+
+
+async def handle_query(query, history, faq_context, vector_store, get_summary, file_id):
+    classification_prompt = f"""
+    You are an FAQ chatbot. Analyze the provided FAQ context and the user query.
+- If the query is more like the greeting, closing, or any other general conversation like 'Hello..', 'Greetings..', etc.., respond with "Greeting".
+- If the query is not related to the topic of the FAQ context and also the history of the conversation, at all (i.e., less than 10% related), respond with "unrelated".
+- If the query is related to the FAQ context and also the history of the conversation, but the answer is not available in the FAQ context, then label it as "needs web search". If after attempting web search the answer is still not found, label it as "keep in db".        
+- If the query is answerable directly from the FAQ context, provide the answer using the context.
+- If it's a follow-up question (e.g., "Tell me more", "Can you explain further", etc.), label it as "follow up".
+    FAQ Context: {faq_context}
+    User Query: {query}
+    History : {history}
+    """
+    model = clients.model()
+    # A stored summary is read alongside classification; a missing one is only generated by a branch that uses it,
+    # so greeting and unrelated turns never pay for the full-document summary prompt.
+    summary_task = asyncio.ensure_future(get_summary(allow_generate=False))
+
+    async def summary():
+        return await summary_task or await get_summary()
+
+    try:
+        return await classify_and_answer(model, classification_prompt, query, history, faq_context, vector_store, summary, file_id)
+    finally:
+        summary_task.cancel()
+
+
+async def classify_and_answer(model, classification_prompt, query, history, faq_context, vector_store, get_summary, file_id):
+    await report_stage("classification")
+    started = time.perf_counter()
+    classification_response = (await generate(model, classification_prompt)).lower()
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_stage("classification", time.perf_counter() - started)
+    
+    if "unrelated" in classification_response:
+        tag_branch("unrelated")
+        alt_response = await generate(model, f"""
+Prompt:
+You are a query classifier. Your task is to determine whether a given query is related to the provided reference content. The reference content can be any document—this may include FAQs, articles, bullet points, or any other format—and it can cover any topic.
+
+Instructions:
+
+Reference Content:
+You will receive a piece of content. It could be in any format (plain text, JSON, bullet points, etc.) and about any topic or information.
+
+Classification Task:
+When you receive a query, use the following rules to classify it:
+
+YES: If the query is related to the content provided.
+Example: If the reference is about a workplace collaboration tool and the query asks, "Who is the founder of [tool]?" or "What is meant by the [particular feature] of the [tool] ?" it should be classified as YES, even if the founder's name isn’t mentioned.
+NO: If the query is unrelated to the provided content.
+Example: If the reference is about a workplace tool and the query asks, "What are Elon Musk's latest projects?" it should be classified as NO.
+Output Format:
+For each query, respond with either YES or NO (without any additional commentary).
+
+Example Scenario:
+
+Reference Content (any format):
+"This document describes a new collaboration tool that helps teams manage projects, share files, and communicate effectively."
+
+Query: "How can teams share files using this tool?"
+Output: YES
+
+Query : "What are similar products available in the market?"
+Output: YES
+                                              
+Query: "What is the history of space exploration?"
+Output: NO
+
+Now, using these guidelines, classify the following query:
+                                                       
+{faq_context}
+Query: {query}
+Output (YES or NO):
+""")
+        if "yes" in alt_response.lower():
+            tag_branch("future_query")
+            return await record_future_query(vector_store, query)
+        else:
+            return "It is not related to the document."
+
+    elif "greeting" in classification_response:
+        tag_branch("greeting")
+        return await answer_greeting(model, query, history)
+        
+    elif "needs web search" in classification_response:
+        tag_branch("needs_web_search")
+        summary = await get_summary()
+        web_answer = await get_web_answer(file_id, query, refine=lambda q: modify_query_for_web(q, summary))
+        return await answer_with_web(model, query, history, web_answer, summary, vector_store)
+    elif "follow up" in classification_response:
+        tag_branch("follow_up")
+        return await answer_follow_up(model, query, history, await get_summary())
+    else:
+        tag_branch("answer")
+        return await answer_directly(model, query, history, await get_summary())
+
+
+@traced("future_query")
+async def record_future_query(vector_store, query: str) -> str:
+    await run_blocking("vector", vector_semaphore, vector_store.add_texts, [query], namespace="New Queries")
+    return FUTURE_ANSWER
+
+
+@traced("answer")
+async def answer_greeting(model, query: str, history: str) -> str:
+    greeting_prompt = f"""
+        Answer the general user query based on the conversation history, provided
+        If the conversation history is empty, provide a general response.
+        User Query: {query}
+        Chat History: {history}
+        """
+    return await generate_answer(model, greeting_prompt)
+
+
+@traced("answer")
+async def answer_with_web(model, query: str, history: str, web_answer: str, summary: str, vector_store) -> str:
+    combined_prompt = f"""
+    Answer the following user query using both the FAQ context and the web information.
+    If the web information is not relevant or is unable to provide an answer, then perform your own web search and use your own knowledge to answer the User Query based on the provided FAQ Context.
+    Consider the Chat history for conversation context.
+    User Query: {query}
+    FAQ Context: {summary}
+    Web Information: {web_answer}
+    Chat History: {history}
+
+    Note : In the response, do not provide like, "As per the FAQ context, the answer is" or "Based on the provided FAQ Context". Instead, provide the answer directly.
+    Note: In the response, do not provide anything like 'I found this information on the web' or 'I searched the web for you' or 'Based on the provided FAQ Context'. Instead, provide the answer directly.
+    Note : The answer should always be on support of the FAQ context.
+    """
+    final_response = await generate(model, combined_prompt)
+    if not final_response.strip() or await is_unsatisfactory(final_response):
+        return await record_future_query(vector_store, query)
+    else:
+        # Only the query is embedded, so later questions can match it; the answer rides along as metadata.
+        await run_blocking("vector", vector_semaphore, vector_store.add_texts, [query], metadatas=[{"response": final_response}], namespace="Web Queries")
+        return final_response
+
+
+@traced("answer")
+async def answer_follow_up(model, query: str, history: str, summary: str) -> str:
+    follow_up_prompt = f"""
+        Answer the user query based on the provided FAQ context and the chat history.
+        User Query: {query}
+        FAQ Context Summary: {summary}
+        Chat History: {history}
+        """
+    return await generate_answer(model, follow_up_prompt)
+
+
+@traced("answer")
+async def answer_directly(model, query: str, history: str, summary: str) -> str:
+    prompt = f"User Query: {query}\nFAQ Context Summary: {summary}\nChat History: {history}\nProvide a direct answer."
+    return await generate_answer(model, prompt)
+
+
+@traced("routing")
+async def route_query(query: str, history: str, faq_context: str) -> dict | None:
+    if stream_events.get() is None:
+        answer_key = '"answer": when intent is "answer", "greeting" or "follow_up", the complete answer to the user; otherwise "". Do not write phrases like "Based on the provided FAQ context", answer directly.'
+    else:
+        # A streamed request writes the answer in its own streamed call, so the router returns without generating one.
+        answer_key = '"answer": always "".'
+    routing_prompt = f"""
+    You are the router of an FAQ chatbot. Analyze the FAQ context, the chat history and the user query, and respond with a single JSON object with these keys:
+    - "rewritten_query": the user query rewritten to remove pronouns (using the chat history) and expand shortcuts such as "shld = should", "wt = what", "abt = about", "wdym = what do you mean", "exp = explain", "plz = please", "u = you", "r = are", "w = with", "w/o = without", "wrt = with respect to".
+    - "intent": one of "greeting" (greeting, closing or general conversation), "answer" (answerable directly from the FAQ context), "follow_up" (e.g. "Tell me more", "Can you explain further"), "needs_web_search" (related to the FAQ context but the answer is not in it) or "unrelated" (not related to the FAQ context or the conversation at all).
+    - "related": true if the query is related to the topic of the FAQ context (e.g. asking who founded a product the FAQ describes), even when the answer is not in it; otherwise false.
+    - "web_query": when intent is "needs_web_search", a concise web search query with only the key terms; otherwise "".
+    - {answer_key}
+    FAQ Context: {faq_context}
+    User Query: {query}
+    History : {history}
+    """
+    model = clients.model(response_mime_type="application/json")
+    await report_stage("routing")
+    try:
+        route = json.loads(await generate(model, routing_prompt))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(route, dict) or route.get("intent") not in ROUTE_INTENTS:
+        return None
+    route["rewritten_query"] = str(route.get("rewritten_query") or query).strip()
+    return route
+
+
+async def handle_routed_query(route: dict, history: str, vector_store, get_summary, file_id: int) -> str:
+    query = route["rewritten_query"]
+    answer = str(route.get("answer") or "").strip()
+    model = clients.model()
+    tag_branch("future_query" if route["intent"] == "unrelated" and route.get("related") else route["intent"])
+    if route["intent"] == "unrelated":
+        if route.get("related"):
+            return await record_future_query(vector_store, query)
+        return "It is not related to the document."
+    elif route["intent"] == "needs_web_search":
+        web_query = str(route.get("web_query") or "").strip() or query
+        web_answer, summary = await asyncio.gather(get_web_answer(file_id, web_query), get_summary())
+        return await answer_with_web(model, query, history, web_answer, summary, vector_store)
+    elif answer and stream_events.get() is None:
+        # Streamed requests route without an answer and generate it below, so its tokens arrive as they are produced.
+        return answer
+    elif route["intent"] == "greeting":
+        return await answer_greeting(model, query, history)
+    elif route["intent"] == "follow_up":
+        return await answer_follow_up(model, query, history, await get_summary())
+    else:
+        return await answer_directly(model, query, history, await get_summary())
+
+
+@traced("rewrite")
+async def rewrite_query(query: str, history: str) -> str:
+    await report_stage("rewrite")
+    model = clients.model()
+    rewritten = await generate(
+                    model,
+                    f"""
+                    Rewrite the given query to remove pronouns and clarify shortcuts.
+                    Consider the following common shortcuts: "shld = should", "wt = what", "abt = about", "wdym = what do you mean", "exp = explain", "plz = please", "u = you", "r = are", "w = with", "w/o = without", "wrt = with respect to", "wrt = with regard to", "wrt = with reference to".
+                    Example 1:
+                    Input: What is shoptalk
+                    Output: Who are shoptalk competitors?
+                    Example 2:
+                    Input: Explain the features of shoptalk
+                    Output: Explain the features of shoptalk in detail
+                    Example 3:
+                    Input: What is the pricing of shoptalk
+                    Output: Explain about the pricing of shoptalk in detail
+
+                    User Query: {query}
+                    Chat History: {history}
+                    Output: Provide only the modified query as a single sentence."""
+                )
+    return rewritten.strip()
+
+
+@traced("context")
+def retrieval_query(query: str, history: str) -> str:
+    # Single routing mode retrieves before the query is rewritten, so the previous question supplies what pronouns refer to.
+    previous = next((line for line in reversed(history.splitlines()) if line.startswith("user: ")), None)
+    return f"{previous.removeprefix('user: ')}\n{query}" if previous else query
+
+
+async def build_context(vector_store, query: str, faq_chunks: list[str], context_mode: str) -> str:
+    if context_mode == "retrieval":
+        return await retrieve_context(vector_store, query, faq_chunks)
+    return "\n".join(faq_chunks)
+
+
+@traced("answer_cache")
+async def find_cached_answer(file_key: tuple, query: str, vector_store) -> tuple[str | None, list[float]]:
+    # Not run_blocking: EmbeddingService counts the lookups that miss its cache as "embed" upstream calls itself.
+    async with embed_semaphore:
+        vector = await asyncio.to_thread(embeddings.embed_query, query)
+    answer = answer_cache.lookup(file_key, vector)
+    if answer is None:
+        run_in_background(seed_answer_cache(file_key, query, vector, vector_store))
+    return answer, vector
+
+
+async def seed_answer_cache(file_key: tuple, query: str, query_vector: list[float], vector_store):
+    """Copy a matching answer from the "Web Queries" namespace into the answer cache, off the request path."""
+    current_trace.set(None)
+    try:
+        # Entries there were embedded as documents, so the query is too for the scores to be comparable.
+        async with embed_semaphore:
+            vector = (await asyncio.to_thread(embeddings.embed_documents, [query]))[0]
+        matches = await run_blocking("vector", vector_semaphore, vector_store.similarity_search_by_vector_with_score, vector, k=1, namespace="Web Queries")
+    except Exception:
+        logger.exception("Could not seed the answer cache for %r", query)
+        return
+    if matches and matches[0][1] >= ANSWER_CACHE_THRESHOLD and matches[0][0].metadata.get("response"):
+        answer_cache.store(file_key, query, query_vector, matches[0][0].metadata["response"])
+        answer_cache.seeded += 1
+
+
+async def answer_query(query: str, history: str, load_chunks, context_mode: str, vector_store, get_summary, file_id: int, file_version: int | None = None) -> str:
+    # Answers are cached under the self-contained (rewritten) query, so turns with history can hit the cache too.
+    current_branch.set(None)
+    cache_query, cache_vector = None, None
+
+    async def check_cache(self_contained_query: str) -> str | None:
+        nonlocal cache_query, cache_vector
+        if not ANSWER_CACHE_ENABLED or cache_vector is not None:
+            return None
+        cache_query = self_contained_query
+        cached, cache_vector = await find_cached_answer((file_id, file_version), cache_query, vector_store)
+        if cached is not None:
+            tag_branch("answer_cache")
+        return cached
+
+    if ROUTING_MODE == "single":
+        # Without history the query is already self-contained, so the cache can be checked before the routing call.
+        if not history.strip() and (cached := await check_cache(query)) is not None:
+            return cached
+        faq_chunks = await load_chunks
+        route = await route_query(query, history, await build_context(vector_store, retrieval_query(query, history), faq_chunks, context_mode))
+        if route is not None:
+            if route["intent"] != "follow_up" and (cached := await check_cache(route["rewritten_query"])) is not None:
+                return cached
+            response = await handle_routed_query(route, history, vector_store, get_summary, file_id)
+        else:
+            user_query = await rewrite_query(query, history)
+            if (cached := await check_cache(user_query)) is not None:
+                return cached
+            faq_context = await build_context(vector_store, user_query, faq_chunks, context_mode)
+            response = await handle_query(user_query, history, faq_context, vector_store, get_summary, file_id)
+    else:
+        user_query, faq_chunks = await asyncio.gather(rewrite_query(query, history), load_chunks)
+        if (cached := await check_cache(user_query)) is not None:
+            return cached
+        faq_context = await build_context(vector_store, user_query, faq_chunks, context_mode)
+        response = await handle_query(user_query, history, faq_context, vector_store, get_summary, file_id)
+
+    # A follow-up answer depends on the turns before it, so it is not reused for other conversations.
+    if cache_vector is not None and current_branch.get() != "follow_up" and response.strip() and response != FUTURE_ANSWER:
+        answer_cache.store((file_id, file_version), cache_query, cache_vector, response)
+    return response
+
+
+@traced("db_write")
+def store_turn(db: Session, user_id: int, file_id: int, query: str, response: str):
+    now = datetime.utcnow()
+    db.add_all([
+        Conversation(user_id=user_id, file_id=file_id, role="user", content=query, timestamp=now),
+        Conversation(user_id=user_id, file_id=file_id, role="assistant", content=response, timestamp=now),
+    ])
+    db.commit()
+
+
+def recent_messages(db: Session, user_id: int, file_id: int, turns: int = HISTORY_TURNS):
+    return (
+        db.query(Conversation.id, Conversation.role, Conversation.content)
+        .filter(Conversation.user_id == user_id, Conversation.file_id == file_id)
+        .order_by(Conversation.id.desc())
+        .limit(turns * 2)
+        .all()
+    )
+
+
+def get_memory(db: Session, user_id: int, file_id: int) -> ConversationMemory | None:
+    return db.query(ConversationMemory).filter(ConversationMemory.user_id == user_id, ConversationMemory.file_id == file_id).first()
+
+
+@traced("history")
+def load_history(user_id: int, file_id: int) -> str:
+    """Prompt history: the rolling summary of older turns, then the most recent turns verbatim, each within its token budget."""
+    # Uses its own session so it can run alongside the request's chunk loading.
+    with SessionLocal() as db:
+        memory = get_memory(db, user_id, file_id)
+        rows = recent_messages(db, user_id, file_id)
+    recent = fit_to_budget([f"{row.role}: {truncate_to_budget(row.content, HISTORY_TOKEN_BUDGET // 2)}" for row in rows], HISTORY_TOKEN_BUDGET)
+    lines = [f"Summary of the earlier conversation: {memory.summary}"] if memory and memory.summary else []
+    return "\n".join(lines + recent[::-1])
+
+
+def read_unsummarized(user_id: int, file_id: int) -> tuple[str, list]:
+    """The previous summary and the messages that have dropped out of the recent window but are not in it yet."""
+    with SessionLocal() as db:
+        recent = recent_messages(db, user_id, file_id)
+        if len(recent) < HISTORY_TURNS * 2:
+            return "", []
+        memory = get_memory(db, user_id, file_id)
+        rows = (
+            db.query(Conversation.id, Conversation.role, Conversation.content)
+            .filter(
+                Conversation.user_id == user_id,
+                Conversation.file_id == file_id,
+                Conversation.id > (memory.summarized_through if memory else 0),
+                Conversation.id < recent[-1].id,
+            )
+            .order_by(Conversation.id)
+            .limit(MEMORY_FOLD_BATCH)
+            .all()
+        )
+        return (memory.summary if memory else "") or "", rows
+
+
+def write_memory(user_id: int, file_id: int, summary: str, summarized_through: int):
+    with SessionLocal() as db:
+        memory = get_memory(db, user_id, file_id)
+        if memory is None:
+            memory = ConversationMemory(user_id=user_id, file_id=file_id)
+            db.add(memory)
+        memory.summary = summary
+        memory.summarized_through = summarized_through
+        memory.updated_at = datetime.utcnow()
+        db.commit()
+
+
+memory_locks: dict[tuple[int, int], asyncio.Lock] = {}
+background_tasks: set[asyncio.Task] = set()
+
+
+async def update_conversation_memory(user_id: int, file_id: int):
+    """Fold turns that left the recent window into the rolling summary, so prompts stay the same size as the chat grows."""
+    # Runs after the request finished, so its model call is not part of that request's trace.
+    current_trace.set(None)
+    async with memory_locks.setdefault((user_id, file_id), asyncio.Lock()):
+        try:
+            previous, rows = await asyncio.to_thread(read_unsummarized, user_id, file_id)
+            if not rows:
+                return
+            transcript = "\n".join(f"{row.role}: {truncate_to_budget(row.content, HISTORY_TOKEN_BUDGET // 2)}" for row in rows)
+            prompt = f"""
+            Update the running summary of a conversation between a user and an FAQ chatbot with the new messages below.
+            Keep the facts, names, questions and answers later turns may refer to, and drop greetings and filler.
+            Respond with the updated summary only, in at most {MEMORY_SUMMARY_TOKEN_BUDGET * 3 // 4} words.
+            Current Summary: {previous or "(none)"}
+            New Messages:
+            {transcript}
+            """
+            summary = (await generate(clients.model(), prompt)).strip()
+            await asyncio.to_thread(write_memory, user_id, file_id, truncate_to_budget(summary, MEMORY_SUMMARY_TOKEN_BUDGET), rows[-1].id)
+        except Exception:
+            logger.exception("Could not update conversation memory for user %s, file %s", user_id, file_id)
+
+
+def run_in_background(coro):
+    # The task is referenced here so it is not garbage collected mid-flight.
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def schedule_memory_update(user_id: int, file_id: int):
+    # Runs after the response is ready.
+    run_in_background(update_conversation_memory(user_id, file_id))
+
+
+async def run_chat_turn(db: Session, user_id: int, file_rec: FileRecord, query: str, pinecone_api_key: str) -> str:
+    vector_store = get_vector_backend(pinecone_api_key, user_id).get_store(file_rec.pinecone_index)
+    load_chunks = asyncio.ensure_future(asyncio.to_thread(get_faq_chunks, db, file_rec))
+    history = await asyncio.to_thread(load_history, user_id, file_rec.id)
+
+    async def get_summary(allow_generate: bool = True):
+        return await get_file_summary(file_rec.id, "\n".join(await load_chunks), allow_generate)
+
+    bot_response = await answer_query(
+        query, history, load_chunks, file_rec.context_mode or DEFAULT_CONTEXT_MODE, vector_store, get_summary, file_rec.id, file_rec.live_chunk_id,
+    )
+    # The chunk load shares this session, so it has to finish before the turn is stored.
+    await asyncio.wait([load_chunks])
+    await asyncio.to_thread(store_turn, db, user_id, file_rec.id, query, bot_response)
+    schedule_memory_update(user_id, file_rec.id)
+    return bot_response
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def warm_up_clients():
+    """Import the model and vector SDKs ahead of the first request, which would otherwise pay for them on the event loop."""
+    loaders = {"genai": load_genai, "embeddings": lambda: embeddings.base}
+    if VECTOR_BACKEND != "local":
+        # Clients need the caller's API key, so only the modules are loaded here.
+        loaders["pinecone"] = lambda: (importlib.import_module("pinecone"), importlib.import_module("langchain_pinecone"))
+    for name, load in loaders.items():
+        try:
+            load()
+        except Exception:
+            logger.warning("Could not warm up %s", name, exc_info=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    resume_ingestion_jobs()
+    stop = threading.Event()
+    threading.Thread(target=maintain_ingestion_jobs, args=(stop,), name="ingest-lease", daemon=True).start()
+    if WARM_UP_CLIENTS:
+        run_in_background(asyncio.to_thread(warm_up_clients))
+    yield
+    stop.set()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.post("/signup", status_code=201)
+def signup(user: UserCreate, db: Session = Depends(get_db)):
+    if db.query(User).filter(User.username == user.username).first():
+        raise HTTPException(status_code=400, detail="Username already exists.")
+    new_user = User(username=user.username, password=hash_password(user.password))
+    db.add(new_user)
+    db.commit()
+    db.refresh(new_user)
+    return {"message": "Signup successful. Please log in."}
+
+
+@app.post("/login", response_model=TokenData)
+def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = db.query(User).filter(User.username == form_data.username).first()
+    # Unknown usernames are checked against a dummy hash, so response time does not reveal which usernames exist.
+    matches, needs_rehash = verify_password(form_data.password, user.password if user else dummy_password_hash())
+    matches = matches and user is not None
+    if not matches:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if needs_rehash:
+        user.password = hash_password(form_data.password)
+        db.commit()
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
+    return {"access_token": access_token, "token_type": "bearer"}
+
+@app.post("/files/upload", response_model=FileUploadResponse, status_code=202)
+async def upload_file(
+    pinecone_api_key: str = Form(""),
+    file_name: str = Form(...),
+    file: UploadFile = File(...),
+    context_mode: str = Form(DEFAULT_CONTEXT_MODE),
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    validate_context_mode(context_mode)
+    get_vector_backend(pinecone_api_key, current_user.id)
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    if file_ext not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Unsupported file type.")
+    file_index = sanitize_file_name(file_name)
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    upload_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}{file_ext}")
+    with open(upload_path, "wb") as out:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, out)
+
+    # Re-uploading a file name updates that file in place, so only changed chunks are re-embedded.
+    file_rec = (
+        db.query(FileRecord)
+        .filter(FileRecord.user_id == current_user.id, FileRecord.file_name == file_name)
+        .order_by(FileRecord.id.desc())
+        .first()
+    )
+    if file_rec and file_rec.status == "processing":
+        os.remove(upload_path)
+        raise HTTPException(status_code=409, detail="This file is still being processed.")
+    if file_rec:
+        if file_rec.status == "ready" and file_rec.live_chunk_id is None:
+            # Files indexed before chunk versions were tracked get one now, so they stay chattable during the re-index.
+            file_rec.live_chunk_id = db.query(func.max(FileChunk.id)).filter(FileChunk.file_id == file_rec.id).scalar() or 0
+        file_rec.context_mode = context_mode
+        file_rec.status = "processing"
+        message = "File re-uploaded. Only changed content will be re-indexed."
+    else:
+        # The document text lives in file_chunks; file_content is only kept for files uploaded before that.
+        file_rec = FileRecord(user_id=current_user.id, file_name=file_name, pinecone_index=file_index, context_mode=context_mode, status="processing")
+        db.add(file_rec)
+        db.flush()
+        message = "File uploaded. Processing has started."
+    job = IngestionJob(
+        user_id=current_user.id, file_id=file_rec.id, upload_path=upload_path, file_ext=file_ext,
+        worker_id=WORKER_ID, heartbeat_at=datetime.utcnow(),
+    )
+    db.add(job)
+    db.commit()
+    ingestion_executor.submit(run_ingestion_job, job.id, pinecone_api_key)
+    return {"message": message, "job_id": job.id, "file_id": file_rec.id}
+
+
+@app.get("/files/jobs/{job_id}", response_model=IngestionJobInfo)
+def get_ingestion_job(job_id: int, current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    job = db.query(IngestionJob).filter(IngestionJob.id == job_id, IngestionJob.user_id == current_user.id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_info(job)
+
+
+@app.get("/files", response_model=list[FileInfo])
+def list_files(current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    files = db.query(FileRecord).filter(FileRecord.user_id == current_user.id).all()
+    latest_jobs = {}
+    for job_id, file_id in db.query(IngestionJob.id, IngestionJob.file_id).filter(IngestionJob.user_id == current_user.id).order_by(IngestionJob.id):
+        latest_jobs[file_id] = job_id
+    return [
+        {"id": f.id, "file_name": f.file_name, "context_mode": f.context_mode or DEFAULT_CONTEXT_MODE, "status": f.status or "ready", "job_id": latest_jobs.get(f.id)}
+        for f in files
+    ]
+
+
+@app.get("/files/{file_id}", response_model=FileInfo)
+def get_file(file_id: int, current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    file_rec = db.query(FileRecord).filter(FileRecord.id == file_id, FileRecord.user_id == current_user.id).first()
+    if not file_rec:
+        raise HTTPException(status_code=404, detail="File not found")
+    file_content = file_rec.file_content or "\n\n".join(get_faq_chunks(db, file_rec))
+    return {"id": file_rec.id, "file_name": file_rec.file_name, "file_content": file_content, "context_mode": file_rec.context_mode or DEFAULT_CONTEXT_MODE}
+
+
+@app.post("/files/{file_id}/context-mode", response_model=FileInfo)
+def set_context_mode(file_id: int, context_mode: str = Form(...), current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    file_rec = db.query(FileRecord).filter(FileRecord.id == file_id, FileRecord.user_id == current_user.id).first()
+    if not file_rec:
+        raise HTTPException(status_code=404, detail="File not found")
+    file_rec.context_mode = validate_context_mode(context_mode)
+    db.commit()
+    return {"id": file_rec.id, "file_name": file_rec.file_name, "context_mode": file_rec.context_mode}
+
+
+def is_chattable(file_rec: FileRecord) -> bool:
+    # A re-upload keeps answering from the previously indexed chunks until its job completes.
+    status = file_rec.status or "ready"
+    return status == "ready" or (status == "processing" and file_rec.live_chunk_id is not None)
+
+
+@app.post("/chat/query", response_model=ChatResponse)
+async def chat_query(
+    pinecone_api_key: str = Form(""),
+    file_id: int = Form(...),
+    query: str = Form(...),
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    
+    file_rec = db.query(FileRecord).filter(FileRecord.id == file_id, FileRecord.user_id == current_user.id).first()
+    if not file_rec:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not is_chattable(file_rec):
+        raise HTTPException(status_code=409, detail=f"File is not ready for chat (status: {file_rec.status}).")
+    
+    with request_trace("/chat/query"):
+        bot_response = await run_chat_turn(db, current_user.id, file_rec, query, pinecone_api_key)
+    return {"response": bot_response}
+
+
+@app.post("/chat/query/stream")
+async def chat_query_stream(
+    pinecone_api_key: str = Form(""),
+    file_id: int = Form(...),
+    query: str = Form(...),
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    file_rec = db.query(FileRecord).filter(FileRecord.id == file_id, FileRecord.user_id == current_user.id).first()
+    if not file_rec:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not is_chattable(file_rec):
+        raise HTTPException(status_code=409, detail=f"File is not ready for chat (status: {file_rec.status}).")
+    user_id = current_user.id
+    # Reject a missing Pinecone key with a 400 before the stream starts.
+    get_vector_backend(pinecone_api_key, current_user.id)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def run_turn():
+        stream_events.set(queue)
+        try:
+            with SessionLocal() as stream_db, request_trace("/chat/query/stream"):
+                response = await run_chat_turn(stream_db, user_id, file_rec, query, pinecone_api_key)
+            await queue.put(("done", {"response": response}))
+        except Exception as e:
+            await queue.put(("error", {"detail": str(e)}))
+
+    async def event_stream():
+        task = asyncio.create_task(run_turn())
+        streamed = False
+        try:
+            while True:
+                event, data = await queue.get()
+                if event == "token":
+                    streamed = True
+                elif event == "done" and not streamed:
+                    yield sse_event("token", {"text": data["response"]})
+                yield sse_event(event, data)
+                if event in ("done", "error"):
+                    break
+        finally:
+            task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+
+@app.get("/chat/history/{file_id}", response_model=ConversationPage)
+def chat_history(
+    file_id: int,
+    before: int | None = None,
+    limit: int = HISTORY_PAGE_SIZE,
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Pages go backwards from the newest message; pass next_cursor as before to get the previous page.
+    limit = max(1, min(limit, HISTORY_PAGE_SIZE))
+    convs = db.query(Conversation).filter(Conversation.user_id == current_user.id, Conversation.file_id == file_id)
+    if before is not None:
+        convs = convs.filter(Conversation.id < before)
+    convs = convs.order_by(Conversation.id.desc()).limit(limit + 1).all()
+    has_more = len(convs) > limit
+    convs = list(reversed(convs[:limit]))
+    return {
+        "messages": [
+            ConversationRecord(
+                id=c.id,
+                role=c.role,
+                content=c.content,
+                timestamp=c.timestamp
+            )
+            for c in convs
+        ],
+        "next_cursor": convs[0].id if has_more else None,
+    }
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"answer_cache": answer_cache.stats(), "embeddings": embeddings.stats(), "web": web_cache.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/config/pinecone")
+def config_pinecone(pinecone_api_key: str = Form(...)):
+    try:
+        clients.index_names(pinecone_api_key)
+        return {"message": "Pinecone API key is valid."}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("backend:app", host="0.0.0.0", port=8000, reload=True)
+
+
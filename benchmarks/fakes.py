@@ -0,0 +1,180 @@
+"""Local stand-ins for Gemini, the embeddings model, Pinecone and the phi web agent.
+
+Each fake sleeps for a configurable latency and counts its calls in `calls`,
+so benchmarks measure the service itself plus a controlled upstream cost.
+Set the environment the backend needs before importing this module.
+"""
+import asyncio
+import hashlib
+import json
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import backend
+
+LATENCY = {"llm": 0.05, "embed": 0.02, "vector": 0.01, "pinecone": 0.02, "web": 0.2}
+calls = Counter()
+_calls_lock = threading.Lock()
+_vector_root = tempfile.mkdtemp(prefix="bench-vectors-")
+
+
+def record(kind: str, count: int = 1):
+    with _calls_lock:
+        calls[kind] += count
+
+
+def snapshot() -> Counter:
+    with _calls_lock:
+        return Counter(calls)
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Answers the router with an "answer" intent, or "needs_web_search" for questions about founders."""
+
+    def __init__(self, model_name=None, system_instruction=None, generation_config=None, **kwargs):
+        self.system_instruction = system_instruction or ""
+
+    def _reply(self, prompt: str) -> str:
+        user_part = prompt.split("User Query:")[-1].split("History")[0]
+        if "You are the router" in prompt:
+            web = "founde" in user_part.lower()
+            return json.dumps({
+                "rewritten_query": user_part.strip(),
+                "intent": "needs_web_search" if web else "answer",
+                "related": True,
+                "web_query": "company founder" if web else "",
+                "answer": "" if web else "Refunds are accepted within 30 days of purchase.",
+            })
+        if "sentence classifier" in self.system_instruction:
+            return "Satisfactory"
+        if "running summary" in prompt:
+            return "The user asked about refunds and the company's founders."
+        if "report generator" in self.system_instruction:
+            return "The FAQ covers refunds, shipping and account management."
+        return "The company was founded in 2015 by two engineers."
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        record("llm")
+        await asyncio.sleep(LATENCY["llm"])
+        text = self._reply(prompt)
+        if not stream:
+            return FakeResponse(text)
+
+        async def chunks():
+            for word in text.split(" "):
+                yield FakeResponse(word + " ")
+        return chunks()
+
+
+class FakeEmbeddings:
+    """Deterministic unit vectors derived from the text, so identical texts embed identically."""
+
+    def _vector(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(backend.EMBEDDING_DIM).tolist()
+
+    def embed_documents(self, texts, task_type=None, **kwargs):
+        record("embed")
+        time.sleep(LATENCY["embed"])
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text, **kwargs):
+        return self.embed_documents([text])[0]
+
+
+class FakeIndex:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakePinecone:
+    indexes: set[str] = set()
+
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+
+    def list_indexes(self):
+        record("pinecone")
+        time.sleep(LATENCY["pinecone"])
+        return [{"name": name} for name in sorted(self.indexes)]
+
+    def create_index(self, name, **kwargs):
+        record("pinecone")
+        time.sleep(LATENCY["pinecone"])
+        self.indexes.add(name)
+
+    def Index(self, name):
+        return FakeIndex(name)
+
+
+class FakeVectorStore(backend.LocalVectorStore):
+    """Pinecone-backed store replaced by the local store, with per-call latency."""
+
+    def __init__(self, index: FakeIndex, embedding, **kwargs):
+        super().__init__(index.name, embedding, root=_vector_root)
+
+    def add_texts(self, texts, metadatas=None, namespace=None, ids=None, **kwargs):
+        texts = list(texts)
+        record("vector")
+        time.sleep(LATENCY["vector"])
+        return super().add_texts(texts, metadatas=metadatas, namespace=namespace, ids=ids)
+
+    def delete(self, ids, namespace=None, **kwargs):
+        record("vector")
+        time.sleep(LATENCY["vector"])
+        return super().delete(ids, namespace=namespace)
+
+    def batch_similarity_search_by_vector_with_score(self, vectors, k=4, namespace=None):
+        record("vector")
+        time.sleep(LATENCY["vector"])
+        return super().batch_similarity_search_by_vector_with_score(vectors, k=k, namespace=namespace)
+
+
+class FakeAgentMemory:
+    def clear(self):
+        pass
+
+
+class FakeAgentResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def get_content_as_string(self):
+        return self.content
+
+
+class FakeAgent:
+    def __init__(self, *args, **kwargs):
+        self.memory = FakeAgentMemory()
+
+    def run(self, prompt, **kwargs):
+        record("web")
+        time.sleep(LATENCY["web"])
+        return FakeAgentResponse("The company was founded in 2015 by two engineers.")
+
+
+def fake_search(query: str) -> str:
+    record("web")
+    time.sleep(LATENCY["web"])
+    return "Example Corp: founded in 2015 by two engineers (https://example.com/about)"
+
+
+def install(latency: dict | None = None):
+    """Point every upstream client in backend at the fakes."""
+    LATENCY.update(latency or {})
+    backend.create_generative_model = FakeGenerativeModel
+    backend.embeddings.base_factory = FakeEmbeddings
+    backend.create_pinecone_client = FakePinecone
+    backend.create_pinecone_store = FakeVectorStore
+    backend.create_web_agent = FakeAgent
+    backend.search_duckduckgo = fake_search
+    backend.search_serpapi = lambda query: ""
@@ -0,0 +1,95 @@
+"""Measure password hashing cost and /login throughput under a burst of logins.
+
+Reports the time to verify one password at each PBKDF2 iteration count,
+then drives /login in-process at the given concurrency. It also drives an
+authenticated endpoint to show the cost of the token check on its own:
+
+    python benchmarks/login_throughput.py --concurrency 16 --logins 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_workdir = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_workdir}/bench.db")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", f"{_workdir}/embedding_cache.db")
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("TRACING_ENABLED", "false")
+
+import httpx  # noqa: E402
+
+import backend  # noqa: E402
+
+
+def percentiles(latencies: list[float]) -> dict:
+    cuts = statistics.quantiles(latencies, n=100)
+    return {"p50_ms": round(cuts[49] * 1000, 2), "p95_ms": round(cuts[94] * 1000, 2), "p99_ms": round(cuts[98] * 1000, 2)}
+
+
+def hash_cost(iterations: int, rounds: int = 20) -> dict:
+    stored = backend.hash_password("benchmark-password", iterations)
+    latencies = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        backend.verify_password("benchmark-password", stored)
+        latencies.append(time.perf_counter() - started)
+    return {"iterations": iterations, **percentiles(latencies)}
+
+
+async def burst(client, name: str, count: int, concurrency: int, make_request) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            (await make_request()).raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    wall = time.perf_counter() - started
+    return {"scenario": name, "requests": count, "concurrency": concurrency, **percentiles(latencies), "rps": round(count / wall, 1)}
+
+
+async def run(args) -> list[dict]:
+    transport = httpx.ASGITransport(app=backend.app)
+    async with backend.lifespan(backend.app), httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/signup", json={"username": "bench", "password": "bench-password"})
+        credentials = {"username": "bench", "password": "bench-password"}
+        token = (await client.post("/login", data=credentials)).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        return [
+            await burst(client, "login", args.logins, args.concurrency, lambda: client.post("/login", data=credentials)),
+            await burst(client, "authenticated_request", args.logins, args.concurrency, lambda: client.get("/files", headers=headers)),
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--iterations", type=int, nargs="+", default=[100_000, backend.PASSWORD_HASH_ITERATIONS, 600_000])
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    report = {
+        "password_iterations": backend.PASSWORD_HASH_ITERATIONS,
+        "hash_cost": [hash_cost(n) for n in sorted(set(args.iterations))],
+        "results": asyncio.run(run(args)),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
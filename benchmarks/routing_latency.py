@@ -0,0 +1,128 @@
+"""Compare per-turn latency of the single-call router and the multi-call chain.
+
+Gemini is replaced by a stub that sleeps for a fixed time per call, so the
+numbers reflect how many sequential model calls each routing mode makes.
+
+    python benchmarks/routing_latency.py --latency 0.05 --turns 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+
+import backend  # noqa: E402
+
+SCENARIOS = {
+    "Hello there": "greeting",
+    "What is the refund policy": "answer",
+    "Tell me more": "follow_up",
+    "Who founded the company": "needs_web_search",
+    "What are the latest space missions": "unrelated",
+}
+CHAIN_LABELS = {
+    "greeting": "greeting",
+    "answer": "Refunds are accepted within 30 days.",
+    "follow_up": "follow up",
+    "needs_web_search": "needs web search",
+    "unrelated": "unrelated",
+}
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    latency = 0.05
+    calls = 0
+
+    def __init__(self, model_name=None, system_instruction=None, **kwargs):
+        self.system_instruction = system_instruction or ""
+
+    async def generate_content_async(self, prompt, **kwargs):
+        StubModel.calls += 1
+        await asyncio.sleep(StubModel.latency)
+        user_part = prompt.split("User Query:")[-1]
+        intent = next((i for q, i in SCENARIOS.items() if q in user_part), "answer")
+        if "You are the router" in prompt:
+            answer = "" if intent in ("needs_web_search", "unrelated") else "Refunds are accepted within 30 days."
+            return StubResponse(json.dumps({
+                "rewritten_query": next(q for q, i in SCENARIOS.items() if i == intent),
+                "intent": intent,
+                "related": False,
+                "web_query": "company founder" if intent == "needs_web_search" else "",
+                "answer": answer,
+            }))
+        if "Rewrite the given query" in prompt:
+            return StubResponse(next(q for q in SCENARIOS if q in user_part))
+        if "You are an FAQ chatbot" in prompt:
+            return StubResponse(CHAIN_LABELS[intent])
+        if "sentence classifier" in self.system_instruction:
+            return StubResponse("Satisfactory")
+        if "Output (YES or NO)" in prompt:
+            return StubResponse("NO")
+        return StubResponse("The company was founded in 2015.")
+
+
+class StubVectorStore:
+    def add_texts(self, texts, **kwargs):
+        return ["stub"] * len(texts)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return []
+
+
+async def faq_chunks():
+    return ["Refunds are accepted within 30 days."]
+
+
+async def cached_summary(allow_generate=True):
+    return "summary"
+
+
+def run(mode: str, turns: int) -> dict:
+    backend.ROUTING_MODE = mode
+    latencies = []
+    StubModel.calls = 0
+    for _ in range(turns):
+        for query in SCENARIOS:
+            start = time.perf_counter()
+            asyncio.run(backend.answer_query(query, "", faq_chunks(), "full", StubVectorStore(), cached_summary, 1))
+            latencies.append(time.perf_counter() - start)
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "p50_ms": round(cuts[49] * 1000, 1),
+        "p95_ms": round(cuts[94] * 1000, 1),
+        "model_calls_per_request": round(StubModel.calls / len(latencies), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per stubbed model call")
+    parser.add_argument("--turns", type=int, default=20, help="rounds over the scenario set")
+    args = parser.parse_args()
+
+    StubModel.latency = args.latency
+    backend.ANSWER_CACHE_ENABLED = False
+    backend.create_generative_model = StubModel
+    async def web_answer(file_id, query, refine=None):
+        return "The company was founded in 2015."
+
+    backend.get_web_answer = web_answer
+    print(json.dumps([run("chain", args.turns), run("single", args.turns)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Drive /files/upload, /chat/query and /chat/history in-process against fake upstreams.
+
+Gemini, the embeddings model, Pinecone and the web agent are replaced by the
+fakes in benchmarks/fakes.py, each sleeping for the given latency. Every
+scenario reports p50/p95/p99 latency, requests per second, upstream calls
+per request and the process's peak RSS. Results are written as JSON, keyed
+by the current git commit, so two runs can be compared:
+
+    python benchmarks/service_load.py --concurrency 8 --requests 200
+    python benchmarks/service_load.py --compare benchmarks/results/<commit>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+_workdir = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_workdir}/bench.db")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", f"{_workdir}/embedding_cache.db")
+os.environ.setdefault("UPLOAD_DIR", f"{_workdir}/uploads")
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ["VECTOR_BACKEND"] = "pinecone"
+
+import httpx  # noqa: E402
+
+import backend  # noqa: E402
+import fakes  # noqa: E402
+
+PINECONE_KEY = "benchmark-key"
+QUERIES = [
+    "What is the refund policy?",
+    "How long does shipping take?",
+    "Can I change my account email?",
+    "Who founded the company?",
+    "Do you ship internationally?",
+]
+
+
+def faq_document(n: int, sections: int) -> bytes:
+    paragraphs = [f"Section {i} of document {n}. " + "Refunds, shipping and account details. " * 20 for i in range(sections)]
+    return "\n\n".join(paragraphs).encode("utf-8")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(name: str, latencies: list[float], errors: int, wall: float, before, after, concurrency: int) -> dict:
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0]] * 99
+    requests = len(latencies) + errors
+    return {
+        "scenario": name,
+        "requests": requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "p50_ms": round(cuts[49] * 1000, 1),
+        "p95_ms": round(cuts[94] * 1000, 1),
+        "p99_ms": round(cuts[98] * 1000, 1),
+        "rps": round(requests / wall, 1),
+        "upstream_calls_per_request": {kind: round((after[kind] - before[kind]) / requests, 2) for kind in sorted(fakes.LATENCY)},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def drive(name: str, count: int, concurrency: int, make_request) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await make_request(i)
+            except Exception as e:
+                errors += 1
+                print(f"{name} request {i} failed: {e}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    before = fakes.snapshot()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    wall = time.perf_counter() - started
+    return summarize(name, latencies or [0.0], errors, wall, before, fakes.snapshot(), concurrency)
+
+
+async def wait_for_job(client, headers, job_id: int, poll: float = 0.02) -> dict:
+    while True:
+        job = (await client.get(f"/files/jobs/{job_id}", headers=headers)).raise_for_status().json()
+        if job["status"] == "completed":
+            return job
+        if job["status"] == "failed":
+            raise RuntimeError(job["error"])
+        await asyncio.sleep(poll)
+
+
+async def upload(client, headers, file_name: str, content: bytes) -> dict:
+    response = await client.post(
+        "/files/upload",
+        headers=headers,
+        data={"pinecone_api_key": PINECONE_KEY, "file_name": file_name},
+        files={"file": (f"{file_name}.txt", content, "text/plain")},
+    )
+    return response.raise_for_status().json()
+
+
+async def run(args) -> list[dict]:
+    # ASGITransport does not send lifespan events, so the app's startup runs here.
+    transport = httpx.ASGITransport(app=backend.app)
+    async with backend.lifespan(backend.app), httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        await client.post("/signup", json={"username": "bench", "password": "bench"})
+        token = (await client.post("/login", data={"username": "bench", "password": "bench"})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        chat_file = await upload(client, headers, "bench-faq", faq_document(0, args.sections))
+        await wait_for_job(client, headers, chat_file["job_id"])
+        results = []
+
+        async def upload_request(i):
+            accepted = await upload(client, headers, f"bench-upload-{i}", faq_document(i + 1, args.sections))
+            await wait_for_job(client, headers, accepted["job_id"])
+
+        results.append(await drive("upload_and_ingest", args.uploads, args.concurrency, upload_request))
+
+        async def chat_request(i):
+            response = await client.post(
+                "/chat/query",
+                headers=headers,
+                data={"pinecone_api_key": PINECONE_KEY, "file_id": chat_file["file_id"], "query": QUERIES[i % len(QUERIES)]},
+            )
+            response.raise_for_status()
+
+        results.append(await drive("chat_query", args.requests, args.concurrency, chat_request))
+
+        async def history_request(i):
+            response = await client.get(f"/chat/history/{chat_file['file_id']}", headers=headers)
+            response.raise_for_status()
+
+        results.append(await drive("chat_history", args.requests, args.concurrency, history_request))
+        # Let memory updates scheduled by the last chat turns finish before the loop closes.
+        await asyncio.gather(*backend.background_tasks, return_exceptions=True)
+        return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    for result in current["results"]:
+        old = baseline.get(result["scenario"])
+        if not old:
+            continue
+        changes = ", ".join(
+            f"{key} {old[key]} -> {result[key]} ({(result[key] - old[key]) / old[key] * 100:+.1f}%)"
+            for key in ("p50_ms", "p95_ms", "p99_ms", "rps") if old[key]
+        )
+        print(f"{result['scenario']}: {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per chat and history scenario")
+    parser.add_argument("--uploads", type=int, default=10)
+    parser.add_argument("--sections", type=int, default=50, help="paragraphs per uploaded document")
+    for kind, default in fakes.LATENCY.items():
+        parser.add_argument(f"--{kind}-latency", type=float, default=default, help=f"seconds per fake {kind} call")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to print changes against")
+    args = parser.parse_args()
+
+    latency = {kind: getattr(args, f"{kind}_latency") for kind in fakes.LATENCY}
+    fakes.install(latency)
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "settings": {"concurrency": args.concurrency, "requests": args.requests, "uploads": args.uploads, "sections": args.sections, "latency": latency},
+        "results": asyncio.run(run(args)),
+    }
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"Saved to {output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Measure backend import time, startup and first-request latency in fresh interpreters.
+
+Each run starts a new Python process that imports backend, runs the app's
+lifespan startup, serves one request in-process and then times the first use
+of each lazily imported SDK. Medians over the runs are printed, and the
+command exits non-zero if the import is slower than --max-import-ms or pulls
+in a heavy SDK eagerly:
+
+    python benchmarks/startup_time.py --runs 5 --max-import-ms 1500
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules backend must only import on first use.
+LAZY_MODULES = ("google.generativeai", "langchain_google_genai", "langchain_pinecone", "pinecone", "phi", "PyPDF2", "docx")
+
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def child():
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{workdir}/bench.db")
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", f"{workdir}/embedding_cache.db")
+    os.environ.setdefault("UPLOAD_DIR", f"{workdir}/uploads")
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    import httpx
+
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    import backend
+    result = {"import_ms": elapsed_ms(started), "eager_modules": [m for m in LAZY_MODULES if m in sys.modules]}
+
+    async def serve():
+        started = time.perf_counter()
+        async with backend.lifespan(backend.app):
+            result["startup_ms"] = elapsed_ms(started)
+            transport = httpx.ASGITransport(app=backend.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                started = time.perf_counter()
+                (await client.post("/signup", json={"username": "bench", "password": "bench"})).raise_for_status()
+                result["first_request_ms"] = elapsed_ms(started)
+
+    asyncio.run(serve())
+
+    first_use = {
+        "genai": backend.load_genai,
+        "embeddings": backend.create_base_embeddings,
+        "pinecone": lambda: backend.create_pinecone_client("benchmark"),
+        "web_agent": backend.create_web_agent,
+        "pdf_parser": lambda: importlib.import_module("PyPDF2"),
+        "docx_parser": lambda: importlib.import_module("docx"),
+    }
+    result["first_use_ms"] = {}
+    for name, load in first_use.items():
+        started = time.perf_counter()
+        load()
+        result["first_use_ms"][name] = elapsed_ms(started)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, help="fail if the median import time is above this")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"], cwd=ROOT, text=True)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    report = {
+        "runs": args.runs,
+        **{key: statistics.median(r[key] for r in runs) for key in ("import_ms", "startup_ms", "first_request_ms")},
+        "first_use_ms": {name: statistics.median(r["first_use_ms"][name] for r in runs) for name in runs[0]["first_use_ms"]},
+        "eager_modules": sorted({m for r in runs for m in r["eager_modules"]}),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if report["eager_modules"]:
+        sys.exit(f"Imported at startup instead of on first use: {', '.join(report['eager_modules'])}")
+    if args.max_import_ms and report["import_ms"] > args.max_import_ms:
+        sys.exit(f"Median import took {report['import_ms']} ms, above the {args.max_import_ms} ms limit")
+
+
+if __name__ == "__main__":
+    main()
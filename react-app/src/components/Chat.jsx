@@ -9,28 +9,39 @@ const Chat = ({ selectedFile }) => {
   const [messages, setMessages] = useState([])
   const [query, setQuery] = useState('')
   const [loading, setLoading] = useState(false)
+  const [stage, setStage] = useState('')
+  const [nextCursor, setNextCursor] = useState(null)
+  const [loadingEarlier, setLoadingEarlier] = useState(false)
   const [noHistoryMessage] = useState('There is no Conversation for this file yet.')
 
-  const fetchHistory = async () => {
+  const fetchHistory = async (before = null) => {
     if (!selectedFile) {
       setMessages([])
+      setNextCursor(null)
       return
     }
     try {
       const response = await axios.get(
         `http://localhost:8000/chat/history/${selectedFile.id}`,
-        { headers: { Authorization: `Bearer ${token}` } }
+        {
+          headers: { Authorization: `Bearer ${token}` },
+          params: before ? { before } : {},
+        }
       )
-      if (response.data.length === 0) {
-        setMessages([])
-      } else {
-        setMessages(response.data)
-      }
+      const page = response.data.messages
+      setMessages((prev) => (before ? [...page, ...prev] : page))
+      setNextCursor(response.data.next_cursor)
     } catch (err) {
       console.error('Error fetching history:', err)
     }
   }
 
+  const loadEarlier = async () => {
+    setLoadingEarlier(true)
+    await fetchHistory(nextCursor)
+    setLoadingEarlier(false)
+  }
+
   useEffect(() => {
     fetchHistory()
   }, [selectedFile])
@@ -40,32 +51,75 @@ const Chat = ({ selectedFile }) => {
       alert('Please ensure you have selected a file, entered a query, and set your Pinecone API key.')
       return
     }
+    const userQuery = query
     setLoading(true)
+    setStage('')
+    setMessages((prev) => [
+      ...prev,
+      { role: 'user', content: userQuery },
+      { role: 'assistant', content: '' },
+    ])
+    setQuery('')
+
+    const updateAnswer = (update) => {
+      setMessages((prev) => {
+        const next = [...prev]
+        const last = next[next.length - 1]
+        next[next.length - 1] = { ...last, content: update(last.content) }
+        return next
+      })
+    }
+
+    const handleEvent = (rawEvent) => {
+      let event = 'message'
+      let data = ''
+      rawEvent.split('\n').forEach((line) => {
+        if (line.startsWith('event: ')) event = line.slice(7)
+        else if (line.startsWith('data: ')) data += line.slice(6)
+      })
+      if (!data) return
+      const payload = JSON.parse(data)
+      if (event === 'stage') setStage(payload.stage)
+      else if (event === 'token') updateAnswer((content) => content + payload.text)
+      else if (event === 'done') updateAnswer(() => payload.response)
+      else if (event === 'error') throw new Error(payload.detail)
+    }
+
     try {
-      const historyStr = messages.map((m) => `${m.role}: ${m.content}`).join('\n')
       const formData = new FormData()
       formData.append('pinecone_api_key', pineconeKey)
       formData.append('file_id', selectedFile.id)
-      formData.append('query', query)
-      formData.append('history', historyStr)
+      formData.append('query', userQuery)
 
-      const response = await axios.post(
-        'http://localhost:8000/chat/query',
-        formData,
-        { headers: { Authorization: `Bearer ${token}` } }
-      )
+      const response = await fetch('http://localhost:8000/chat/query/stream', {
+        method: 'POST',
+        headers: { Authorization: `Bearer ${token}` },
+        body: formData,
+      })
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}))
+        throw new Error(errorData.detail || 'Enter the respective Pinecone API you used to store the file')
+      }
 
-      setMessages((prev) => [
-        ...prev,
-        { role: 'user', content: query },
-        { role: 'assistant', content: response.data.response },
-      ])
-      setQuery('')
+      const reader = response.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ''
+      while (true) {
+        const { value, done } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+        const events = buffer.split('\n\n')
+        buffer = events.pop()
+        events.forEach(handleEvent)
+      }
     } catch (err) {
       console.error('Error sending message: ', err)
-      alert(err.response?.data.detail || 'Enter the respective Pinecone API you used to store the file')
+      setMessages((prev) => prev.slice(0, -2))
+      setQuery(userQuery)
+      alert(err.message || 'Enter the respective Pinecone API you used to store the file')
     } finally {
       setLoading(false)
+      setStage('')
     }
   }
 
@@ -80,6 +134,13 @@ const Chat = ({ selectedFile }) => {
     >
       <Card.Body style={{ flex: 1, overflowY: 'auto' }}>
         <h5>Chat with: {selectedFile ? selectedFile.file_name : 'No file selected'}</h5>
+        {nextCursor && (
+          <div className="text-center mb-2">
+            <Button variant="link" size="sm" onClick={loadEarlier} disabled={loadingEarlier}>
+              {loadingEarlier ? <Spinner animation="border" size="sm" /> : 'Load earlier messages'}
+            </Button>
+          </div>
+        )}
         {messages.length === 0 ? (
           <Alert variant="info">{noHistoryMessage}</Alert>
         ) : (
@@ -99,7 +160,11 @@ const Chat = ({ selectedFile }) => {
                   }}
                 >
                   <strong>{isUser ? 'You' : 'Bot'}</strong>:{' '}
-                  <ReactMarkdown>{msg.content}</ReactMarkdown>
+                  {!isUser && !msg.content && loading ? (
+                    <em>{stage ? `Working on it (${stage.replace('_', ' ')})...` : 'Thinking...'}</em>
+                  ) : (
+                    <ReactMarkdown>{msg.content}</ReactMarkdown>
+                  )}
                 </ListGroup.Item>
               )
             })}
@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useContext } from 'react'
-import { Accordion, Spinner, Alert, Card } from 'react-bootstrap'
+import { Accordion, Spinner, Alert, Card, Badge } from 'react-bootstrap'
 import axios from 'axios'
 import { AuthContext } from '../contexts/AuthContext'
 import ReactMarkdown from 'react-markdown'
@@ -10,6 +10,7 @@ const FileList = () => {
   const [fileDetails, setFileDetails] = useState({})
   const [loadingDetails, setLoadingDetails] = useState({})
   const [error, setError] = useState('')
+  const [jobs, setJobs] = useState({})
 
   const fetchFiles = async () => {
     try {
@@ -43,6 +44,49 @@ const FileList = () => {
     fetchFiles()
   }, [])
 
+  useEffect(() => {
+    const processing = files.filter((file) => file.status === 'processing' && file.job_id)
+    if (processing.length === 0) return
+    const timer = setInterval(async () => {
+      let finished = false
+      await Promise.all(processing.map(async (file) => {
+        try {
+          const response = await axios.get(`http://localhost:8000/files/jobs/${file.job_id}`, {
+            headers: { Authorization: `Bearer ${token}` },
+          })
+          setJobs(prev => ({ ...prev, [file.id]: response.data }))
+          if (response.data.status === 'completed' || response.data.status === 'failed') finished = true
+        } catch (err) {
+          console.error(err)
+        }
+      }))
+      if (finished) fetchFiles()
+    }, 2000)
+    return () => clearInterval(timer)
+  }, [files])
+
+  const renderStatus = (file) => {
+    const job = jobs[file.id]
+    if (file.status === 'processing') {
+      return (
+        <Badge bg="warning" text="dark" className="ms-2">
+          Processing{job ? ` · ${job.stage} · ${job.chunk_count} chunks` : ''}
+        </Badge>
+      )
+    }
+    if (file.status === 'failed') {
+      return <Badge bg="danger" className="ms-2">Failed</Badge>
+    }
+    if (job && job.status === 'completed') {
+      return (
+        <Badge bg="secondary" className="ms-2">
+          {job.chunks_added} added · {job.chunks_unchanged} unchanged · {job.chunks_removed} removed
+        </Badge>
+      )
+    }
+    return null
+  }
+
   return (
     <div className="m-3">
       {error && <Alert variant="danger">{error}</Alert>}
@@ -54,12 +98,17 @@ const FileList = () => {
             {files.map(file => (
               <Accordion.Item eventKey={file.id.toString()} key={file.id}>
                 <Accordion.Header
-                  onClick={() => fetchFileDetail(file.id)}
+                  onClick={() => file.status !== 'processing' && fetchFileDetail(file.id)}
                 >
                   {file.file_name}
+                  {renderStatus(file)}
                 </Accordion.Header>
                 <Accordion.Body>
-                  {loadingDetails[file.id] ? (
+                  {file.status === 'processing' ? (
+                    <Alert variant="warning">This file is still being processed. Its content will be available once indexing finishes.</Alert>
+                  ) : file.status === 'failed' ? (
+                    <Alert variant="danger">{jobs[file.id]?.error || 'Processing failed. Please upload the file again.'}</Alert>
+                  ) : loadingDetails[file.id] ? (
                     <Spinner animation="border" size="sm" />
                   ) : (
                     <Card style={{ height: '300px', overflowY: 'auto' }}>
@@ -43,7 +43,7 @@ const Sidebar = ({ setSelectedFile, selectedFile }) => {
       await axios.post('http://localhost:8000/files/upload', formData, {
         headers: { Authorization: `Bearer ${token}` },
       })
-      setMessage('File uploaded successfully.')
+      setMessage('File uploaded. It is being processed; check the Files tab for progress.')
       setFileName('')
       setFileData(null)
       fetchFiles()
@@ -109,6 +109,8 @@ const Sidebar = ({ setSelectedFile, selectedFile }) => {
                 onClick={() => setSelectedFile(file)}
               >
                 {file.file_name}
+                {file.status === 'processing' && <small className="ms-2">(processing)</small>}
+                {file.status === 'failed' && <small className="ms-2">(failed)</small>}
               </ListGroup.Item>
             ))}
           </ListGroup>